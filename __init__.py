@@ -21,7 +21,15 @@ def register():
         aeat.TaxCodeProrrataMapping,
         aeat.TaxCodeRelation,
         aeat.TaxCodeProrrataRelation,
+        aeat.TaxCodeBalance,
+        aeat.UpdateMappingsStart,
+        aeat.ExportReportsResult,
+        aeat.ImportFilesStart,
         account.Move,
+        account.FiscalYear,
+        account.Period,
+        account.TaxCode,
+        account.TaxCodeLine,
         module='aeat_303', type_='model')
     Pool.register(
         statement.Origin,
@@ -30,4 +38,7 @@ def register():
     Pool.register(
         aeat.CreateChart,
         aeat.UpdateChart,
+        aeat.UpdateMappings,
+        aeat.ExportReports,
+        aeat.ImportFiles,
         module='aeat_303', type_='wizard')
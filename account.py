@@ -17,3 +17,94 @@ class Move(metaclass=PoolMeta):
         if self.origin and isinstance(self.origin, Report):
             return True
         return result
+
+
+class FiscalYear(metaclass=PoolMeta):
+    __name__ = 'account.fiscalyear'
+
+    @classmethod
+    def close(cls, fiscalyears):
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        super().close(fiscalyears)
+        years = set()
+        for fiscalyear in fiscalyears:
+            years.update(range(fiscalyear.start_date.year,
+                    fiscalyear.end_date.year + 1))
+        Report.archive_files(Report.search([
+                    ('company', 'in', [f.company.id for f in fiscalyears]),
+                    ('year', 'in', list(years)),
+                    ('file_id', '!=', None),
+                    ]))
+
+
+class Period(metaclass=PoolMeta):
+    __name__ = 'account.period'
+
+    @classmethod
+    def close(cls, periods):
+        pool = Pool()
+        Balance = pool.get('aeat.303.tax.code.balance')
+
+        super().close(periods)
+        # Closed periods can not change so their tax code amounts are stored
+        Balance.snapshot(cls.browse(periods))
+
+    @classmethod
+    def reopen(cls, periods):
+        pool = Pool()
+        Balance = pool.get('aeat.303.tax.code.balance')
+
+        super().reopen(periods)
+        Balance.clear(periods)
+
+
+class TaxCode(metaclass=PoolMeta):
+    __name__ = 'account.tax.code'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+
+        super().write(*args)
+        # The mapping plans contain the ids of the codes by company
+        Mapping._mapping_plan_cache.clear()
+
+    @classmethod
+    def delete(cls, codes):
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+
+        super().delete(codes)
+        Mapping._mapping_plan_cache.clear()
+
+
+class TaxCodeLine(metaclass=PoolMeta):
+    __name__ = 'account.tax.code.line'
+
+    @classmethod
+    def _clear_aeat303_balances(cls, lines):
+        pool = Pool()
+        Balance = pool.get('aeat.303.tax.code.balance')
+
+        # The stored amounts depend on the definition of the code lines
+        Balance.clear(companies=list({l.code.company for l in lines}))
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super().create(vlist)
+        cls._clear_aeat303_balances(lines)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        lines = sum(args[0:None:2], [])
+        super().write(*args)
+        cls._clear_aeat303_balances(lines)
+
+    @classmethod
+    def delete(cls, lines):
+        cls._clear_aeat303_balances(lines)
+        super().delete(lines)
@@ -2,21 +2,42 @@
 from decimal import Decimal
 import datetime
 import calendar
+import gzip
 import unicodedata
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import traceback
+import zipfile
 
 from retrofix import aeat303
+from retrofix.exception import RetrofixException
+from retrofix.fields import Const, Date
 from retrofix.record import Record, write as retrofix_write
 import trytond
 from trytond.config import config
+from trytond import backend
+from trytond.cache import Cache, immutable
+from trytond.filestore import filestore
 from trytond.model import Workflow, ModelSQL, ModelView, fields, Unique
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval, Bool
+from trytond.pyson import Eval, Bool, PYSONEncoder
+from trytond.rpc import RPC
 from trytond.i18n import gettext
-from trytond.exceptions import UserError
+from trytond.exceptions import UserError, UserWarning
 from trytond.model.exceptions import ValidationError
-from trytond.transaction import Transaction
-from sql import Literal
-from sql.functions import Extract
+from trytond.tools import grouped_slice, reduce_ids, sqlite_apply_types
+from trytond.transaction import (
+    Transaction, TransactionError, without_check_access)
+from trytond.wizard import (
+    Button, StateAction, StateTransition, StateView, Wizard)
+from sql import Literal, Null, Union, With
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Extract, Round
 
 
 _STATES = {
@@ -29,10 +50,75 @@ _STATES_390 = {
 
 _Z = Decimal("0.0")
 
+# Fields that use to be numeric, but are now const in regards to the aeat 303
+# file
+_EXCLUDED_FIELDS = ['accrued_vat_percent_4', 'accrued_vat_percent_5',
+    'accrued_re_percent_1']
+
+# Deductible fields affected by the prorrata
+_DEDUCTIBLE_FIELDS = ['deductible_current_domestic_operations_tax',
+    'deductible_investment_domestic_operations_tax',
+    'deductible_regularization_tax']
+
+# Boxes summed in the accrued total tax
+_ACCRUED_TAX_FIELDS = ['accrued_vat_tax_0', 'accrued_vat_tax_1',
+    'accrued_vat_tax_4', 'accrued_vat_tax_2', 'accrued_vat_tax_3',
+    'accrued_vat_tax_5', 'intracommunity_adquisitions_tax',
+    'other_passive_subject_tax', 'accrued_vat_tax_modification',
+    'accrued_re_tax_4', 'accrued_re_tax_1', 'accrued_re_tax_2',
+    'accrued_re_tax_3', 'accrued_re_tax_5', 'accrued_re_tax_modification']
+
+# Boxes summed in the deductible total
+_DEDUCTIBLE_TAX_FIELDS = ['deductible_current_domestic_operations_tax',
+    'deductible_investment_domestic_operations_tax',
+    'deductible_current_import_operations_tax',
+    'deductible_investment_import_operations_tax',
+    'deductible_current_intracommunity_operations_tax',
+    'deductible_investment_intracommunity_operations_tax',
+    'deductible_regularization_tax', 'deductible_compensations',
+    'deductible_investment_regularization',
+    'deductible_pro_rata_regularization']
+
+# Boxes added and subtracted in the total operations volume
+_OPERATIONS_VOLUME_FIELDS = ['special_info_rg_operations',
+    'special_info_recc', 'special_info_intracommunity_deliveries_2bdeduced',
+    'special_info_exempt_op_2bdeduced',
+    'special_info_exempt_op_wo_permission_2bdeduced',
+    'special_info_w_passive_subject',
+    'annual_subject_operations_w_reverse_charge',
+    'annual_oss_not_subject_operations', 'annual_oss_subject_operations',
+    'annual_intragroup_transaction', 'special_info_operations_rs',
+    'special_info_farming_cattleraising_fishing',
+    'special_info_passive_subject_re',
+    'special_info_art_antiques_collectibles', 'special_info_travel_agency']
+_OPERATIONS_VOLUME_DEDUCTED_FIELDS = ['special_info_financial_op_not_usual',
+    'special_info_delivery_investment_domestic_operations']
+
+# Records of the file in the order they are written
+_FILE_RECORDS = [aeat303.HEADER_RECORD, aeat303.RECORD, aeat303.GENERAL_RECORD,
+    aeat303.BANK_DATA_RECORD, aeat303.FOOTER_RECORD]
+
+# These fields use to be numeric, but are now const in regards to the aeat 303
+# file (excluding report and bank_account, which were there already)
+_FILE_EXCLUDED_COLUMNS = _EXCLUDED_FIELDS + ['report', 'bank_account']
+
+# Files of the archived years are stored compressed with gzip
+_GZIP_MAGIC = b'\x1f\x8b'
+
 VERSION = trytond.__version__
 VERSION = ''.join(VERSION.split('.')[:4])
 
 NIF = config.get('aeat', 'nif', default='B00000000')
+# Compute the tax code amounts with a grouped query instead of reading the
+# amount of each tax code through the ORM
+SQL_CALCULATION = config.getboolean('aeat', 'sql_calculation', default=True)
+QUEUE_TASKS = config.getboolean('aeat', 'queue', default=False)
+BATCH_SIZE = config.getint('aeat', 'batch_size', default=10)
+# The export archive is returned whole by RPC and kept in memory, so the
+# number of reports exported at once is limited (0 disables the limit)
+EXPORT_LIMIT = config.getint('aeat', 'export_limit', default=200)
+# The errors to retry the whole run of the reports
+_RETRY_EXCEPTIONS = (backend.DatabaseOperationalError, TransactionError)
 
 
 def remove_accents(text):
@@ -44,6 +130,39 @@ def remove_accents(text):
     #return unicodedata.normalize('NFC', unicode_string_nfd)
 
 
+class _FileTranslation(dict):
+    '''
+    Translation table of the characters to their upper case without accents
+    in ISO-8859-1, computed on first use of each character
+    '''
+    __slots__ = ()
+
+    def __missing__(self, key):
+        value = remove_accents(chr(key)).upper()
+        value = value.encode('iso-8859-1', errors='ignore').decode(
+            'iso-8859-1')
+        self[key] = value
+        return value
+
+
+_FILE_TRANSLATION = _FileTranslation()
+for _key in range(256):
+    _FILE_TRANSLATION[_key]
+del _key
+
+
+def encode_file(text):
+    '''
+    Return the text upper case without accents encoded in ISO-8859-1 in a
+    single pass.
+
+    It is the same as remove_accents(text).upper() encoded ignoring the
+    characters out of ISO-8859-1 because each step is done character by
+    character, so it can be applied to any part of the text.
+    '''
+    return text.translate(_FILE_TRANSLATION).encode('iso-8859-1')
+
+
 class TemplateTaxCodeRelation(ModelSQL):
     '''
     AEAT 303 TaxCode Mapping Codes Relation
@@ -92,7 +211,32 @@ class TemplateTaxCodeMapping(ModelSQL):
     def default_type_():
         return 'code'
 
-    def _get_mapping_value(self, mapping=None):
+    @classmethod
+    def get_tax_codes_by_template(cls, companies):
+        '''
+        Return a dictionary with the active tax codes by template of each
+        company
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        tax_code = TaxCode.__table__()
+        cursor = Transaction().connection.cursor()
+
+        active = TaxCode.domain_active(
+            ('active', '=', True), {None: (tax_code, None)})
+        codes = dict((c, {}) for c in companies)
+        for sub_ids in grouped_slice(companies):
+            cursor.execute(*tax_code.select(
+                    tax_code.company, tax_code.template, tax_code.id,
+                    where=reduce_ids(tax_code.company, sub_ids)
+                    & (tax_code.template != Null)
+                    & active,
+                    order_by=[tax_code.id]))
+            for company_id, template_id, code_id in cursor:
+                codes[company_id].setdefault(template_id, []).append(code_id)
+        return codes
+
+    def _get_mapping_value(self, mapping=None, codes=None):
         pool = Pool()
         TaxCode = pool.get('account.tax.code')
 
@@ -109,9 +253,13 @@ class TemplateTaxCodeMapping(ModelSQL):
         if mapping and len(mapping.code) > 0:
             old_ids = set([c.id for c in mapping.code])
         if len(self.code) > 0:
-            new_ids = set([c.id for c in TaxCode.search([
-                            ('template', 'in', [c.id for c in self.code])
-                            ])])
+            if codes is None:
+                new_ids = set([c.id for c in TaxCode.search([
+                                ('template', 'in', [c.id for c in self.code])
+                                ])])
+            else:
+                new_ids = set(code_id for c in self.code
+                    for code_id in codes.get(c.id, []))
         if not mapping or mapping.template != self:
             res['template'] = self.id
         if old_ids or new_ids:
@@ -169,7 +317,7 @@ class TemplateTaxCodeProrrataMapping(ModelSQL):
                 'Field must be unique.')
             ]
 
-    def _get_mapping_value(self, mapping=None):
+    def _get_mapping_value(self, mapping=None, codes=None):
         pool = Pool()
         TaxCode = pool.get('account.tax.code')
 
@@ -182,9 +330,13 @@ class TemplateTaxCodeProrrataMapping(ModelSQL):
         if mapping and len(mapping.code) > 0:
             old_ids = set([c.id for c in mapping.code])
         if len(self.code) > 0:
-            new_ids = set([c.id for c in TaxCode.search([
-                            ('template', 'in', [c.id for c in self.code])
-                            ])])
+            if codes is None:
+                new_ids = set([c.id for c in TaxCode.search([
+                                ('template', 'in', [c.id for c in self.code])
+                                ])])
+            else:
+                new_ids = set(code_id for c in self.code
+                    for code_id in codes.get(c.id, []))
         if not mapping or mapping.template != self:
             res['template'] = self.id
         if old_ids or new_ids:
@@ -208,58 +360,10 @@ class UpdateChart(metaclass=PoolMeta):
 
     def transition_update(self):
         pool = Pool()
-        MappingTemplate = pool.get('aeat.303.template.mapping')
-        MappingProrrataTemplate = pool.get('aeat.303.prorrata.mapping.template')
         Mapping = pool.get('aeat.303.mapping')
-        MappingProrrata = pool.get('aeat.303.prorrata.mapping')
 
         ret = super().transition_update()
-
-        # Update current values
-        ids = []
-        company = self.start.account.company.id
-        for mapping in Mapping.search([
-                    ('company', 'in', [company, None]),
-                    ]):
-            if not mapping.template:
-                continue
-            vals = mapping.template._get_mapping_value(mapping=mapping)
-            if vals:
-                Mapping.write([mapping], vals)
-            ids.append(mapping.template.id)
-
-        # Create new one's
-        to_create = []
-        for template in MappingTemplate.search([('id', 'not in', ids)]):
-            vals = template._get_mapping_value()
-            if vals:
-                vals['company'] = company
-                to_create.append(vals)
-        if to_create:
-            Mapping.create(to_create)
-
-        # Update current values
-        ids = []
-        for mapping in MappingProrrata.search([
-                    ('company', 'in', [company, None]),
-                    ]):
-            if not mapping.template:
-                continue
-            vals = mapping.template._get_mapping_value(mapping=mapping)
-            if vals:
-                Mapping.write([mapping], vals)
-            ids.append(mapping.template.id)
-
-        # Create new one's
-        to_create = []
-        for template in MappingProrrataTemplate.search([('id', 'not in', ids)]):
-            vals = template._get_mapping_value()
-            if vals:
-                vals['company'] = company
-                to_create.append(vals)
-        if to_create:
-            MappingProrrata.create(to_create)
-
+        Mapping.update_companies([self.start.account.company])
         return ret
 
 
@@ -276,9 +380,10 @@ class CreateChart(metaclass=PoolMeta):
         company = self.account.company.id
 
         ret = super().transition_create_account()
+        codes = MappingTemplate.get_tax_codes_by_template([company])[company]
         to_create = []
         for template in MappingTemplate.search([]):
-            vals = template._get_mapping_value()
+            vals = template._get_mapping_value(codes=codes)
             if vals:
                 vals['company'] = company
                 to_create.append(vals)
@@ -286,7 +391,7 @@ class CreateChart(metaclass=PoolMeta):
 
         to_create = []
         for template in MappingProrrataTemplate.search([]):
-            vals = template._get_mapping_value()
+            vals = template._get_mapping_value(codes=codes)
             if vals:
                 vals['company'] = company
                 to_create.append(vals)
@@ -295,7 +400,168 @@ class CreateChart(metaclass=PoolMeta):
         return ret
 
 
-class TaxCodeRelation(ModelSQL):
+class UpdateMappingsStart(ModelView):
+    '''
+    AEAT 303 Update Mappings Start
+    '''
+    __name__ = 'aeat.303.mapping.update.start'
+
+    companies = fields.Many2Many('company.company', None, None, 'Companies',
+        required=True)
+
+
+class UpdateMappings(Wizard):
+    '''
+    AEAT 303 Update Mappings
+    '''
+    __name__ = 'aeat.303.mapping.update'
+    start = StateView('aeat.303.mapping.update.start',
+        'aeat_303.aeat_303_mapping_update_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Update', 'update', 'tryton-ok', default=True),
+            ])
+    update = StateTransition()
+
+    def transition_update(self):
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Mapping.update_companies(self.start.companies)
+        return 'end'
+
+
+class ExportReportsResult(ModelView):
+    '''
+    AEAT 303 Export Reports Result
+    '''
+    __name__ = 'aeat.303.report.export.result'
+
+    file_ = fields.Binary('File', filename='filename', readonly=True)
+    filename = fields.Char('File Name', readonly=True)
+
+
+class ExportReports(Wizard):
+    '''
+    AEAT 303 Export Reports
+    '''
+    __name__ = 'aeat.303.report.export'
+    start_state = 'result'
+    result = StateView('aeat.303.report.export.result',
+        'aeat_303.aeat_303_report_export_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        return {
+            'file_': Report.export_files(self.records),
+            'filename': 'aeat303.zip',
+            }
+
+
+class ImportFilesStart(ModelView):
+    '''
+    AEAT 303 Import Files Start
+    '''
+    __name__ = 'aeat.303.report.import.start'
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+    file_ = fields.Binary('File', filename='filename', required=True,
+        help='An AEAT 303 file or a ZIP archive of files.')
+    filename = fields.Char('File Name')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class ImportFiles(Wizard):
+    '''
+    AEAT 303 Import Files
+    '''
+    __name__ = 'aeat.303.report.import'
+    start = StateView('aeat.303.report.import.start',
+        'aeat_303.aeat_303_report_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateAction('aeat_303.act_aeat_303_report')
+
+    def do_import_(self, action):
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        reports = Report.import_files(self.start.company,
+            Report.get_import_files(self.start.file_, self.start.filename))
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', [r.id for r in reports]),
+                ])
+        return action, {}
+
+
+class MappingPlanMixin:
+    'Clear the cached mapping plans when a mapping is modified'
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('aeat.303.mapping')._mapping_plan_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('aeat.303.mapping')._mapping_plan_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('aeat.303.mapping')._mapping_plan_cache.clear()
+
+
+class CodeByCompaniesMixin:
+    'Resolve the tax codes of the mappings for the context company'
+    __slots__ = ()
+
+    @classmethod
+    def get_code_by_companies(cls, records, name):
+        pool = Pool()
+        Relation = pool.get(cls.code.relation_name)
+        TaxCode = pool.get('account.tax.code')
+        relation = Relation.__table__()
+        tax_code = TaxCode.__table__()
+        cursor = Transaction().connection.cursor()
+        user_company = Transaction().context.get('company')
+
+        res = dict((x.id, []) for x in records)
+        where = tax_code.company == Null
+        if user_company is not None:
+            where |= tax_code.company == user_company
+        for sub_ids in grouped_slice(list(res.keys())):
+            cursor.execute(*relation.join(tax_code,
+                    condition=relation.code == tax_code.id
+                    ).select(relation.mapping, relation.code,
+                    where=reduce_ids(relation.mapping, sub_ids) & where,
+                    order_by=[relation.mapping, relation.code]))
+            for mapping_id, code_id in cursor:
+                res[mapping_id].append(code_id)
+        return res
+
+    @classmethod
+    def search_code_by_companies(cls, name, clause):
+        user_company = Transaction().context.get('company')
+        _, operator, value = clause[:3]
+        nested = clause[0][len(name) + 1:] or 'id'
+        return [('code', 'where', [
+                    (nested, operator, value) + tuple(clause[3:]),
+                    ['OR',
+                        ('company', '=', None),
+                        ('company', '=', user_company),
+                        ],
+                    ])]
+
+
+class TaxCodeRelation(MappingPlanMixin, ModelSQL):
     '''
     AEAT 303 TaxCode Mapping Codes Relation
     '''
@@ -305,11 +571,14 @@ class TaxCodeRelation(ModelSQL):
     code = fields.Many2One('account.tax.code', 'Tax Code', required=True)
 
 
-class TaxCodeMapping(ModelSQL, ModelView):
+class TaxCodeMapping(MappingPlanMixin, CodeByCompaniesMixin, ModelSQL,
+        ModelView):
     '''
     AEAT 303 TaxCode Mapping
     '''
     __name__ = 'aeat.303.mapping'
+    _mapping_plan_cache = Cache('aeat.303.mapping.get_mapping_plan',
+        context=False)
 
     company = fields.Many2One('company.company', 'Company',
         ondelete="RESTRICT")
@@ -327,7 +596,8 @@ class TaxCodeMapping(ModelSQL, ModelView):
         })
     code_by_companies = fields.Function(
         fields.Many2Many('aeat.303.mapping-account.tax.code', 'mapping',
-        'code', 'Code by Companies'), 'get_code_by_companies')
+        'code', 'Code by Companies'), 'get_code_by_companies',
+        searcher='search_code_by_companies')
     number = fields.Numeric('Number',
         states={
             'required': Eval('type_') == 'numeric',
@@ -353,19 +623,121 @@ class TaxCodeMapping(ModelSQL, ModelView):
         return Transaction().context.get('company') or None
 
     @classmethod
-    def get_code_by_companies(cls, records, name):
-        user_company = Transaction().context.get('company')
-        res = dict((x.id, None) for x in records)
-        for record in records:
-            code_ids = []
-            for code in record.code:
-                if not code.company or code.company.id == user_company:
-                    code_ids.append(code.id)
-            res[record.id] = code_ids
-        return res
+    def get_mapping_plan(cls, company):
+        '''
+        Return a dictionary with the mapping of the company by type:
+            - code: the report fields of each tax code
+            - exonerated390: the report field of each tax code
+            - numeric: the fixed value of each report field
+            - deductible: the tax codes of the deductible fields
+            - prorrata: the prorrata field of each tax code
+
+        The plan is cached until a mapping or a tax code of any company is
+        modified, so it is always returned immutable.
+        '''
+        pool = Pool()
+        ProrrataMapping = pool.get('aeat.303.prorrata.mapping')
+
+        plan = cls._mapping_plan_cache.get(company.id)
+        if plan is not None:
+            return plan
+
+        plan = {
+            'code': {},
+            'exonerated390': {},
+            'numeric': {},
+            'deductible': [],
+            'prorrata': {},
+            }
+        with Transaction().set_context(company=company.id):
+            for mapp in cls.search([
+                        ('company', '=', company.id),
+                        ]):
+                name = mapp.aeat303_field.name
+                if mapp.type_ == 'code':
+                    for code in mapp.code_by_companies:
+                        plan['code'].setdefault(code.id, []).append(name)
+                elif mapp.type_ == 'exonerated390':
+                    for code in mapp.code_by_companies:
+                        plan['exonerated390'][code.id] = name
+                elif name not in _EXCLUDED_FIELDS:
+                    plan['numeric'][name] = mapp.number
+            for mapp in ProrrataMapping.search([
+                        ('company', '=', company.id),
+                        ]):
+                for code in mapp.code_by_companies:
+                    plan['prorrata'][code.id] = mapp.prorrata_field.name
+        plan['deductible'] = [code_id
+            for code_id, names in plan['code'].items()
+            if any(name in _DEDUCTIBLE_FIELDS for name in names)]
+        plan = immutable(plan)
+        cls._mapping_plan_cache.set(company.id, plan)
+        return plan
 
+    @classmethod
+    def update_companies(cls, companies):
+        '''
+        Create or update the mappings and the prorrata mappings of the
+        companies from their templates
+        '''
+        pool = Pool()
+        MappingTemplate = pool.get('aeat.303.template.mapping')
+        MappingProrrataTemplate = pool.get(
+            'aeat.303.prorrata.mapping.template')
+        MappingProrrata = pool.get('aeat.303.prorrata.mapping')
 
-class TaxCodeProrrataRelation(ModelSQL):
+        company_ids = [c.id for c in companies]
+        codes = MappingTemplate.get_tax_codes_by_template(company_ids)
+        for Mapping, Template in [
+                (cls, MappingTemplate),
+                (MappingProrrata, MappingProrrataTemplate),
+                ]:
+            templates = Template.search([])
+            mappings = Mapping.search([
+                    ('company', 'in', company_ids + [None]),
+                    ])
+            to_create = []
+            to_write = []
+            # The mappings without company are shared by all the companies
+            # so they keep the codes of all the companies
+            shared_ids = set()
+            for mapping in mappings:
+                if mapping.company or not mapping.template:
+                    continue
+                vals = mapping.template._get_mapping_value(mapping=mapping)
+                if vals:
+                    to_write.extend(([mapping], vals))
+                shared_ids.add(mapping.template.id)
+            for company_id in company_ids:
+                # Update current values
+                ids = set(shared_ids)
+                for mapping in mappings:
+                    if not mapping.company or mapping.company.id != company_id:
+                        continue
+                    if not mapping.template:
+                        continue
+                    vals = mapping.template._get_mapping_value(
+                        mapping=mapping, codes=codes[company_id])
+                    if vals:
+                        to_write.extend(([mapping], vals))
+                    ids.add(mapping.template.id)
+
+                # Create new one's
+                for template in templates:
+                    if template.id in ids:
+                        continue
+                    vals = template._get_mapping_value(
+                        codes=codes[company_id])
+                    if vals:
+                        vals['company'] = company_id
+                        to_create.append(vals)
+            if to_write:
+                Mapping.write(*to_write)
+            if to_create:
+                Mapping.create(to_create)
+
+
+class TaxCodeProrrataRelation(MappingPlanMixin, ModelSQL):
     '''
     AEAT 303 TaxCode Prorrata Mapping Relation
     '''
@@ -376,7 +748,8 @@ class TaxCodeProrrataRelation(ModelSQL):
     code = fields.Many2One('account.tax.code', 'Tax Code', required=True)
 
 
-class TaxCodeProrrataMapping(ModelSQL, ModelView):
+class TaxCodeProrrataMapping(MappingPlanMixin, CodeByCompaniesMixin,
+        ModelSQL, ModelView):
     '''
     AEAT 303 TaxCode Prorrata Mapping
     '''
@@ -397,7 +770,8 @@ class TaxCodeProrrataMapping(ModelSQL, ModelView):
         'code', 'Tax Code', states={'required': True})
     code_by_companies = fields.Function(
         fields.Many2Many('aeat.303.prorrata.mapping-account.tax.code', 'mapping',
-        'code', 'Code by Companies'), 'get_code_by_companies')
+        'code', 'Code by Companies'), 'get_code_by_companies',
+        searcher='search_code_by_companies')
     template = fields.Many2One('aeat.303.prorrata.mapping.template', 'Template')
 
     @classmethod
@@ -413,17 +787,111 @@ class TaxCodeProrrataMapping(ModelSQL, ModelView):
     def default_company():
         return Transaction().context.get('company') or None
 
+
+class TaxCodeBalance(ModelSQL):
+    '''
+    AEAT 303 Tax Code Balance
+    '''
+    __name__ = 'aeat.303.tax.code.balance'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    period = fields.Many2One('account.period', 'Period', required=True,
+        ondelete='CASCADE')
+    code = fields.Many2One('account.tax.code', 'Tax Code', required=True,
+        ondelete='CASCADE')
+    amount = fields.Numeric('Amount', required=True)
+
     @classmethod
-    def get_code_by_companies(cls, records, name):
-        user_company = Transaction().context.get('company')
-        res = dict((x.id, None) for x in records)
-        for record in records:
-            code_ids = []
-            for code in record.code:
-                if not code.company or code.company.id == user_company:
-                    code_ids.append(code.id)
-            res[record.id] = code_ids
-        return res
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('period_code_uniq', Unique(t, t.period, t.code),
+                'aeat_303.msg_tax_code_balance_period_code_unique'),
+            ]
+
+    @classmethod
+    def get_amounts(cls, code_ids, periods):
+        '''
+        Return the amount of the own lines of each tax code by period stored
+        for the periods and the periods that have a snapshot
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        code_ids = set(code_ids)
+        amounts = {}
+        snapshot_periods = set()
+        if not periods:
+            return amounts, snapshot_periods
+        query = table.select(table.code.as_('code'),
+            table.period.as_('period'), table.amount.as_('amount'),
+            where=reduce_ids(table.period, list(periods)))
+        if backend.name == 'sqlite':
+            sqlite_apply_types(query, [None, None, 'NUMERIC'])
+        cursor.execute(*query)
+        for code_id, period_id, amount in cursor:
+            snapshot_periods.add(period_id)
+            if code_id in code_ids:
+                amounts[(code_id, period_id)] = Decimal(amount)
+        return amounts, snapshot_periods
+
+    @classmethod
+    @without_check_access
+    def snapshot(cls, periods):
+        'Store the amount of every tax code of the company of the periods'
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        Report = pool.get('aeat.303.report')
+
+        cls.clear(periods)
+        periods_by_company = {}
+        for period in periods:
+            periods_by_company.setdefault(period.company, []).append(
+                period.id)
+        to_create = []
+        for company, period_ids in periods_by_company.items():
+            code_ids = [c.id for c in TaxCode.search([
+                        ('company', '=', company.id),
+                        ])]
+            if not code_ids:
+                continue
+            amounts = Report._get_tax_code_line_amounts(code_ids, period_ids)
+            for period_id in period_ids:
+                for code_id in code_ids:
+                    to_create.append({
+                            'company': company.id,
+                            'period': period_id,
+                            'code': code_id,
+                            'amount': amounts.get((code_id, period_id), _Z),
+                            })
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def update(cls, periods):
+        'Take the snapshot of the closed periods that do not have one yet'
+        periods = [p for p in periods if p.state != 'open']
+        _, snapshot_periods = cls.get_amounts([], [p.id for p in periods])
+        periods = [p for p in periods if p.id not in snapshot_periods]
+        if periods:
+            cls.snapshot(periods)
+
+    @classmethod
+    def clear(cls, periods=None, companies=None):
+        'Remove the snapshot of the periods or companies'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if periods is not None:
+            for sub_periods in grouped_slice(periods):
+                cursor.execute(*table.delete(where=reduce_ids(table.period,
+                            [p.id for p in sub_periods])))
+        if companies is not None:
+            for sub_companies in grouped_slice(companies):
+                cursor.execute(*table.delete(where=reduce_ids(table.company,
+                            [c.id for c in sub_companies])))
 
 
 class Report(Workflow, ModelSQL, ModelView):
@@ -607,7 +1075,7 @@ class Report(Workflow, ModelSQL, ModelView):
     accrued_re_tax_modification = fields.Numeric('Accrued Re Tax '
         'Modification', digits=(15, 2))
     accrued_total_tax = fields.Function(fields.Numeric('Accrued Total Tax',
-            digits=(15, 2)), 'get_accrued_total_tax')
+            digits=(15, 2)), 'get_totals')
     deductible_current_domestic_operations_base = fields.Numeric(
         'Deductible Current Domestic Operations Base', digits=(15, 2))
     deductible_current_domestic_operations_tax = fields.Numeric(
@@ -643,10 +1111,10 @@ class Report(Workflow, ModelSQL, ModelView):
     deductible_pro_rata_regularization = fields.Numeric(
         'Deductible Pro Rata Regularization', digits=(15, 2))
     deductible_total = fields.Function(fields.Numeric('Deductible Total',
-            digits=(15, 2)), 'get_deductible_total')
+            digits=(15, 2)), 'get_totals')
     general_regime_result = fields.Function(fields.Numeric(
             'General Regime Result',
-            digits=(15, 2)), 'get_general_regime_result')
+            digits=(15, 2)), 'get_totals')
     prorrata_percent_applied = fields.Integer('Prorrata Percent Applied')
     prorrata_real_percent = fields.Integer('Prorrata Real Percent')
     preprorrata_deductible_current_domestic_operations_tax = fields.Numeric(
@@ -698,12 +1166,12 @@ class Report(Workflow, ModelSQL, ModelView):
         help="Only fill if you have done the 952 model. To Fill with the tax "
         "to recover.")
     sum_results = fields.Function(fields.Numeric(
-            'Sum of Results', digits=(15, 2)), 'get_sum_results')
+            'Sum of Results', digits=(15, 2)), 'get_totals')
     state_administration_percent = fields.Numeric(
         'State Administration Percent', digits=(15, 2))
     state_administration_amount = fields.Function(
         fields.Numeric('State Administration Amount', digits=(15, 2)),
-        'get_state_administration_amount')
+        'get_totals')
     aduana_tax_pending = fields.Numeric(
         'Aduana Tax Pending', digits=(15, 2),
         help="Import VAT paid by Aduana pending entry")
@@ -720,15 +1188,15 @@ class Report(Workflow, ModelSQL, ModelView):
         'Previous Period Amount To Compensate', digits=(15, 2))
     result_previous_period_amount_to_compensate = fields.Function(
         fields.Numeric('Result Previous Period Amount To Compensate',
-            digits=(15, 2)), 'get_result_previous_period_amount_to_compensate')
+            digits=(15, 2)), 'get_totals')
     joint_taxation_state_provincial_councils = fields.Numeric(
         'Joint Taxation State Provincial Councils', digits=(15, 2))
     result = fields.Function(fields.Numeric('Result', digits=(15, 2)),
-        'get_result')
+        'get_totals', searcher='search_totals')
     before_result = fields.Numeric('Before Result', digits=(15, 2))
     to_deduce = fields.Numeric('To Deduce', digits=(15, 2))
     liquidation_result = fields.Function(fields.Numeric('Liquidation Result',
-        digits=(15, 2)), 'get_liquidation_result')
+        digits=(15, 2)), 'get_totals', searcher='search_totals')
     without_activity = fields.Boolean('Without Activity')
     complementary_declaration = fields.Boolean(
         'Complementary Declaration')
@@ -847,7 +1315,7 @@ class Report(Workflow, ModelSQL, ModelView):
     special_info_total = fields.Function(fields.Numeric(
             'Total Operations Volume', digits=(15, 2),
             states=_STATES_390),
-        'get_total_operations_volume')
+        'get_totals')
 
     # Page 05
     additional_page_indicator = fields.Selection([
@@ -1086,14 +1554,28 @@ class Report(Workflow, ModelSQL, ModelView):
     # Footer
     state = fields.Selection([
             ('draft', 'Draft'),
+            ('calculating', 'Calculating'),
             ('calculated', 'Calculated'),
+            ('processing', 'Processing'),
             ('done', 'Done'),
             ('cancelled', 'Cancelled')
             ], 'State', readonly=True)
     calculation_date = fields.DateTime('Calculation Date', readonly=True)
-    file_ = fields.Binary('File', filename='filename', states={
-            'invisible': Eval('state') != 'done',
-            }, readonly=True)
+    calculation_fingerprint = fields.Char('Calculation Fingerprint',
+        readonly=True)
+    duration = fields.TimeDelta('Duration', readonly=True,
+        help='Time spent by the last background calculation or process of '
+        'the chunk of reports including this one.')
+    error = fields.Text('Error', readonly=True, states={
+            'invisible': ~Eval('error'),
+            },
+        help='Error raised by the last background calculation or process.')
+    file_ = fields.Function(fields.Binary('File', filename='filename',
+            states={
+                'invisible': Eval('state') != 'done',
+                }, readonly=True),
+        'get_file', setter='set_file')
+    file_id = fields.Char('File ID', readonly=True)
     filename = fields.Function(fields.Char("File Name"),
         'get_filename')
 
@@ -1148,28 +1630,43 @@ class Report(Workflow, ModelSQL, ModelView):
             ]
         cls._buttons.update({
                 'draft': {
-                    'invisible': ~Eval('state').in_(['calculated',
-                            'cancelled']),
+                    'invisible': ~Eval('state').in_(['calculating',
+                            'calculated', 'processing', 'cancelled']),
                     },
                 'calculate': {
                     'invisible': ~Eval('state').in_(['draft']),
                     },
+                'force_calculate': {
+                    'invisible': (~Eval('state').in_(['draft'])
+                        | ~Eval('calculation_date')),
+                    'depends': ['calculation_date'],
+                    },
                 'process': {
                     'invisible': ~Eval('state').in_(['calculated']),
                     },
                 'cancel': {
-                    'invisible': Eval('state').in_(['cancelled']),
+                    'invisible': Eval('state').in_(['calculating',
+                            'processing', 'cancelled']),
                     },
                 })
         cls._transitions |= set((
+                ('draft', 'calculating'),
                 ('draft', 'calculated'),
                 ('draft', 'cancelled'),
+                ('calculating', 'draft'),
+                ('calculating', 'calculated'),
                 ('calculated', 'draft'),
+                ('calculated', 'processing'),
                 ('calculated', 'done'),
                 ('calculated', 'cancelled'),
+                ('processing', 'draft'),
+                ('processing', 'done'),
                 ('done', 'cancelled'),
                 ('cancelled', 'draft'),
                 ))
+        cls.__rpc__.update({
+                'export_files': RPC(instantiate=0),
+                })
 
     @classmethod
     def __register__(cls, module_name):
@@ -1216,6 +1713,30 @@ class Report(Workflow, ModelSQL, ModelView):
         if table.column_exist('fiscalyear_code'):
             table.drop_column('fiscalyear_code')
 
+        # Migration from 8.0: move the files to the filestore
+        if table.column_exist('file_'):
+            prefix = Transaction().database.name
+            cursor.execute(*model_table.select(model_table.id,
+                    where=model_table.file_ != Null))
+            ids = [i for i, in cursor]
+            for sub_ids in grouped_slice(ids, BATCH_SIZE):
+                cursor.execute(*model_table.select(model_table.id,
+                        model_table.company, model_table.year,
+                        model_table.file_,
+                        where=reduce_ids(model_table.id, sub_ids)))
+                rows = cursor.fetchall()
+                archived = cls.get_archived_years(
+                    {(c, y) for _, c, y, _ in rows})
+                for report_id, company, year, data in rows:
+                    data = bytes(data)
+                    if (company, year) in archived:
+                        data = gzip.compress(data, mtime=0)
+                    cursor.execute(*model_table.update(
+                            [model_table.file_id],
+                            [filestore.set(data, prefix=prefix)],
+                            where=model_table.id == report_id))
+            table.drop_column('file_')
+
     @staticmethod
     def default_state():
         return 'draft'
@@ -1581,87 +2102,151 @@ class Report(Workflow, ModelSQL, ModelView):
     def get_currency(self, name):
         return self.company.currency.id
 
-    def get_general_regime_result(self, name):
-        return (self.accrued_total_tax or _Z) - (self.deductible_total or _Z)
-
-    def get_accrued_total_tax(self, name):
-        return ((self.accrued_vat_tax_0 or _Z)
-            + (self.accrued_vat_tax_1 or _Z)
-            + (self.accrued_vat_tax_4 or _Z)
-            + (self.accrued_vat_tax_2 or _Z)
-            + (self.accrued_vat_tax_3 or _Z)
-            + (self.accrued_vat_tax_5 or _Z)
-            + (self.intracommunity_adquisitions_tax or _Z)
-            + (self.other_passive_subject_tax or _Z)
-            + (self.accrued_vat_tax_modification or _Z)
-            + (self.accrued_re_tax_4 or _Z)
-            + (self.accrued_re_tax_1 or _Z)
-            + (self.accrued_re_tax_2 or _Z)
-            + (self.accrued_re_tax_3 or _Z)
-            + (self.accrued_re_tax_5 or _Z)
-            + (self.accrued_re_tax_modification or _Z)
-                )
-
-    def get_deductible_total(self, name):
-        return ((self.deductible_current_domestic_operations_tax or _Z)
-            + (self.deductible_investment_domestic_operations_tax or _Z)
-            + (self.deductible_current_import_operations_tax or _Z)
-            + (self.deductible_investment_import_operations_tax or _Z)
-            + (self.deductible_current_intracommunity_operations_tax or _Z)
-            + (self.deductible_investment_intracommunity_operations_tax or _Z)
-            + (self.deductible_regularization_tax or _Z)
-            + (self.deductible_compensations or _Z)
-            + (self.deductible_investment_regularization or _Z)
-            + (self.deductible_pro_rata_regularization or _Z)
-                )
-
-    def get_sum_results(self, name):
-        # Here have to sum the box 46 + 58 + 76. The 58 is only for There
-        #  Regime Simplified. By the moment this type are not supported so
-        #  only sum 46 + 76.
-        return ((self.general_regime_result or _Z)
-            + (self.result_tax_regularitzation or _Z))
-
-    def get_state_administration_amount(self, name):
-        return (self.general_regime_result
-            * (self.state_administration_percent or _Z)
-            / Decimal('100.0'))
-
-    def get_result_previous_period_amount_to_compensate(self, name):
-        return ((self.previous_period_pending_amount_to_compensate or _Z)
-            - (self.previous_period_amount_to_compensate or _Z))
-
-    def get_result(self, name):
-        return ((self.state_administration_amount or _Z)
-            + (self.aduana_tax_pending or _Z)
-            - (self.previous_period_amount_to_compensate or _Z)
-            + (self.joint_taxation_state_provincial_councils or _Z)
-            + (self.complementary_declaration_other_adjustements or _Z))
-
-    def get_liquidation_result(self, name):
-        return ((self.result or _Z) - (self.to_deduce or _Z)
-            + (self.before_result or _Z)
-            + (self.deduct_advance_payments_amount or _Z))
-
-    def get_total_operations_volume(self, name):
-        return ((self.special_info_rg_operations or _Z)
-            + (self.special_info_recc or _Z)
-            + (self.special_info_intracommunity_deliveries_2bdeduced or _Z)
-            + (self.special_info_exempt_op_2bdeduced or _Z)
-            + (self.special_info_exempt_op_wo_permission_2bdeduced or _Z)
-            + (self.special_info_w_passive_subject or _Z)
-            + (self.annual_subject_operations_w_reverse_charge or _Z)
-            + (self.annual_oss_not_subject_operations or _Z)
-            + (self.annual_oss_subject_operations or _Z)
-            + (self.annual_intragroup_transaction or _Z)
-            + (self.special_info_operations_rs or _Z)
-            + (self.special_info_farming_cattleraising_fishing or _Z)
-            + (self.special_info_passive_subject_re or _Z)
-            + (self.special_info_art_antiques_collectibles or _Z)
-            + (self.special_info_travel_agency or _Z)
-            - (self.special_info_financial_op_not_usual or _Z)
-            - (self.special_info_delivery_investment_domestic_operations
+    @classmethod
+    def get_totals(cls, reports, names):
+        '''
+        Return the totals of the reports computed from their stored boxes in
+        a single pass.
+        '''
+        def total(report, fields):
+            return sum((getattr(report, f) or _Z for f in fields), _Z)
+
+        values = {n: {} for n in names}
+        for report in reports:
+            accrued_total_tax = total(report, _ACCRUED_TAX_FIELDS)
+            deductible_total = total(report, _DEDUCTIBLE_TAX_FIELDS)
+            general_regime_result = accrued_total_tax - deductible_total
+            # Here have to sum the box 46 + 58 + 76. The 58 is only for There
+            #  Regime Simplified. By the moment this type are not supported so
+            #  only sum 46 + 76.
+            sum_results = (general_regime_result
+                + (report.result_tax_regularitzation or _Z))
+            state_administration_amount = report.company.currency.round(
+                general_regime_result
+                * (report.state_administration_percent or _Z)
+                / Decimal('100.0'))
+            result_previous_period_amount_to_compensate = (
+                (report.previous_period_pending_amount_to_compensate or _Z)
+                - (report.previous_period_amount_to_compensate or _Z))
+            result = (state_administration_amount
+                + (report.aduana_tax_pending or _Z)
+                - (report.previous_period_amount_to_compensate or _Z)
+                + (report.joint_taxation_state_provincial_councils or _Z)
+                + (report.complementary_declaration_other_adjustements
                     or _Z))
+            liquidation_result = (result - (report.to_deduce or _Z)
+                + (report.before_result or _Z)
+                + (report.deduct_advance_payments_amount or _Z))
+            special_info_total = (
+                total(report, _OPERATIONS_VOLUME_FIELDS)
+                - total(report, _OPERATIONS_VOLUME_DEDUCTED_FIELDS))
+            totals = {
+                'accrued_total_tax': accrued_total_tax,
+                'deductible_total': deductible_total,
+                'general_regime_result': general_regime_result,
+                'sum_results': sum_results,
+                'state_administration_amount': state_administration_amount,
+                'result_previous_period_amount_to_compensate': (
+                    result_previous_period_amount_to_compensate),
+                'result': result,
+                'liquidation_result': liquidation_result,
+                'special_info_total': special_info_total,
+                }
+            for name in names:
+                values[name][report.id] = totals[name]
+        return values
+
+    @classmethod
+    def _get_total_column(cls, table, name):
+        '''
+        Return the SQL expression of the total name computed from the stored
+        boxes of the report table.
+        '''
+        type_ = cls.result._field.sql_type().base
+        if backend.name == 'sqlite':
+            # SQLite casts the integral numerics to integer
+            hundred = Literal(100.0)
+        else:
+            hundred = Literal(100).cast(type_)
+
+        def box(name):
+            return Coalesce(getattr(table, name).cast(type_), 0)
+
+        def total(fields):
+            return sum((box(f) for f in fields[1:]), box(fields[0]))
+
+        if name == 'accrued_total_tax':
+            return total(_ACCRUED_TAX_FIELDS)
+        elif name == 'deductible_total':
+            return total(_DEDUCTIBLE_TAX_FIELDS)
+        elif name == 'general_regime_result':
+            return (cls._get_total_column(table, 'accrued_total_tax')
+                - cls._get_total_column(table, 'deductible_total'))
+        elif name == 'sum_results':
+            return (cls._get_total_column(table, 'general_regime_result')
+                + box('result_tax_regularitzation'))
+        elif name == 'state_administration_amount':
+            _, digits = cls.state_administration_amount._field.digits
+            return Round(
+                cls._get_total_column(table, 'general_regime_result')
+                * box('state_administration_percent') / hundred, digits)
+        elif name == 'result_previous_period_amount_to_compensate':
+            return (box('previous_period_pending_amount_to_compensate')
+                - box('previous_period_amount_to_compensate'))
+        elif name == 'result':
+            return (cls._get_total_column(table, 'state_administration_amount')
+                + box('aduana_tax_pending')
+                - box('previous_period_amount_to_compensate')
+                + box('joint_taxation_state_provincial_councils')
+                + box('complementary_declaration_other_adjustements'))
+        elif name == 'liquidation_result':
+            return (cls._get_total_column(table, 'result')
+                - box('to_deduce')
+                + box('before_result')
+                + box('deduct_advance_payments_amount'))
+        elif name == 'special_info_total':
+            return (total(_OPERATIONS_VOLUME_FIELDS)
+                - total(_OPERATIONS_VOLUME_DEDUCTED_FIELDS))
+        raise KeyError(name)
+
+    @classmethod
+    def search_totals(cls, name, clause):
+        table = cls.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        # The totals are compared once rounded like they are shown
+        _, digits = getattr(cls, name)._field.digits
+        column = Round(cls._get_total_column(table, name), digits)
+        # The totals are never null so a None value only matches with the
+        # null comparisons like fields.Numeric does
+        if isinstance(value, (list, tuple)):
+            value = [v for v in value if v is not None]
+        elif value is None:
+            if operator == '!=':
+                return [('id', '!=', None)]
+            return [('id', '=', None)]
+        # SQLite computes the totals as float
+        if backend.name == 'sqlite':
+            if isinstance(value, (list, tuple)):
+                value = [float(v) for v in value]
+            else:
+                value = float(value)
+        if operator in ('in', 'not in') and not value:
+            if operator == 'in':
+                return [('id', '=', None)]
+            return [('id', '!=', None)]
+        query = table.select(table.id, where=Operator(column, value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def order_result(cls, tables):
+        table, _ = tables[None]
+        return [cls._get_total_column(table, 'result')]
+
+    @classmethod
+    def order_liquidation_result(cls, tables):
+        table, _ = tables[None]
+        return [cls._get_total_column(table, 'liquidation_result')]
 
     def get_deductible_total1(self, name):
         return _Z
@@ -1669,6 +2254,98 @@ class Report(Workflow, ModelSQL, ModelView):
     def get_deductible_total2(self, name):
         return _Z
 
+    @classmethod
+    def get_file(cls, reports, name):
+        transaction = Transaction()
+        prefix = transaction.database.name
+        size = transaction.context.get(
+            '%s.%s' % (cls.__name__, name)) == 'size'
+        res = {}
+        for report in reports:
+            res[report.id] = 0 if size else None
+            if not report.file_id:
+                continue
+            if size:
+                res[report.id] = filestore.size(report.file_id, prefix=prefix)
+                continue
+            data = filestore.get(report.file_id, prefix=prefix)
+            if data[:2] == _GZIP_MAGIC:
+                data = gzip.decompress(data)
+            res[report.id] = fields.Binary.cast(data)
+        return res
+
+    @classmethod
+    def set_file(cls, reports, name, value):
+        prefix = Transaction().database.name
+
+        archived = cls.get_archived_years(
+            {(r.company.id, r.year) for r in reports})
+        to_write = []
+        for report in reports:
+            data = value
+            if data and (report.company.id, report.year) in archived:
+                data = gzip.compress(data, mtime=0)
+            file_id = filestore.set(data, prefix=prefix) if data else None
+            to_write.extend(([report], {'file_id': file_id}))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def get_archived_years(cls, keys):
+        '''
+        Return the (company, year) keys without open fiscal year overlapping
+        the year.
+
+        The files of the reports of these years are stored compressed.
+        '''
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        fiscalyear = FiscalYear.__table__()
+        cursor = Transaction().connection.cursor()
+
+        fiscalyears = {}
+        companies = list({c for c, _ in keys})
+        for sub_ids in grouped_slice(companies):
+            cursor.execute(*fiscalyear.select(fiscalyear.company,
+                    fiscalyear.start_date, fiscalyear.end_date,
+                    fiscalyear.state,
+                    where=reduce_ids(fiscalyear.company, sub_ids)))
+            for company, start_date, end_date, state in cursor:
+                fiscalyears.setdefault(company, []).append(
+                    (start_date, end_date, state))
+
+        archived = set()
+        for company, year in keys:
+            states = [state
+                for start_date, end_date, state in fiscalyears.get(company, [])
+                if start_date.year <= year <= end_date.year]
+            if states and 'open' not in states:
+                archived.add((company, year))
+        return archived
+
+    @classmethod
+    def archive_files(cls, reports):
+        '''
+        Store compressed the files of the reports of archived years
+        '''
+        prefix = Transaction().database.name
+
+        reports = [r for r in reports if r.file_id]
+        archived = cls.get_archived_years(
+            {(r.company.id, r.year) for r in reports})
+        to_write = []
+        for report in reports:
+            if (report.company.id, report.year) not in archived:
+                continue
+            data = filestore.get(report.file_id, prefix=prefix)
+            if data[:2] == _GZIP_MAGIC:
+                continue
+            file_id = filestore.set(gzip.compress(data, mtime=0),
+                prefix=prefix)
+            to_write.extend(([report], {'file_id': file_id}))
+        if to_write:
+            cls.write(*to_write)
+
     def get_filename(self, name):
         return 'aeat303-%s-%s.txt' % (
             self.year, self.period)
@@ -1753,89 +2430,474 @@ class Report(Workflow, ModelSQL, ModelView):
                         self.deductible_regularization_tax)
         return debit
 
+    @classmethod
+    def get_tax_code_amounts(cls, code_ids, periods, currency):
+        'Return a dictionary with the amount of each tax code for the periods'
+        return cls.get_tax_code_amounts_by_periods(
+            code_ids, [periods], currency)[0]
+
+    @classmethod
+    def get_tax_code_amounts_by_periods(cls, code_ids, periods_list,
+            currency):
+        '''
+        Return a list with a dictionary of the amount of each tax code for
+        each list of periods of periods_list.
+
+        The amounts of all the codes and their children are computed with a
+        single grouped query over the tax lines of all the periods and then
+        rounded and accumulated through the tax code tree like
+        account.tax.code does.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        Balance = pool.get('aeat.303.tax.code.balance')
+
+        code_ids = list(set(code_ids))
+        if not code_ids:
+            return [{} for _ in periods_list]
+        if not SQL_CALCULATION:
+            result = []
+            for periods in periods_list:
+                with Transaction().set_context(periods=periods):
+                    result.append({c.id: c.amount
+                            for c in TaxCode.browse(code_ids)})
+            return result
+
+        childs = {}
+        codes = TaxCode.search([
+                ('parent', 'child_of', code_ids),
+                ])
+        for code in codes:
+            if code.parent:
+                childs.setdefault(code.parent.id, []).append(code.id)
+
+        # Closed periods are read from their snapshot and only the others
+        # are aggregated from the tax lines
+        all_periods = set().union(*periods_list)
+        line_amounts, snapshot_periods = Balance.get_amounts(
+            [c.id for c in codes], all_periods)
+        if all_periods - snapshot_periods:
+            line_amounts.update(cls._get_tax_code_line_amounts(
+                    [c.id for c in codes], all_periods - snapshot_periods))
+
+        result = []
+        for periods in periods_list:
+            periods = set(periods)
+            amounts = {}
+            for (code_id, period_id), amount in line_amounts.items():
+                if period_id in periods:
+                    amounts[code_id] = amounts.get(code_id, _Z) + amount
+            totals = {}
+
+            def total(code_id):
+                if code_id not in totals:
+                    amount = currency.round(amounts.get(code_id, _Z))
+                    for child_id in childs.get(code_id, []):
+                        amount += total(child_id)
+                    totals[code_id] = amount
+                return totals[code_id]
+
+            result.append({c: total(c) for c in code_ids})
+        return result
+
+    @classmethod
+    def _get_tax_line_conditions(cls, tax_line, move_line):
+        '''
+        Return the conditions of the tax lines for the invoice and the credit
+        tax code lines like account.tax.code.line _line_domain
+        '''
+        pool = Pool()
+        TaxLine = pool.get('account.tax.line')
+        MoveLine = pool.get('account.move.line')
+
+        amount = tax_line.amount
+        debit = move_line.debit
+        credit = move_line.credit
+        if backend.name == 'sqlite':
+            amount = TaxLine.amount.sql_cast(amount)
+            debit = MoveLine.debit.sql_cast(debit)
+            credit = MoveLine.credit.sql_cast(credit)
+        is_invoice = (
+            ((amount > 0) & ((debit > 0) | (credit > 0)))
+            | ((amount < 0) & ((debit < 0) | (credit < 0)))
+            )
+        is_credit = (
+            ((amount < 0) & ((debit > 0) | (credit > 0)))
+            | ((amount > 0) & ((debit < 0) | (credit < 0)))
+            )
+        return is_invoice, is_credit
+
+    @classmethod
+    def _get_tax_code_line_amounts(cls, code_ids, periods):
+        '''
+        Return the not rounded amount of the own lines of each tax code by
+        period
+        '''
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        TaxLine = pool.get('account.tax.line')
+        CodeLine = pool.get('account.tax.code.line')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        cursor = Transaction().connection.cursor()
+
+        tax_line = TaxLine.__table__()
+        code_line = CodeLine.__table__()
+        move = Move.__table__()
+        move_line = MoveLine.__table__()
+
+        amount = tax_line.amount
+        if backend.name == 'sqlite':
+            amount = TaxLine.amount.sql_cast(tax_line.amount)
+        is_invoice, is_credit = cls._get_tax_line_conditions(
+            tax_line, move_line)
+        value = Case(
+            ((code_line.type == 'invoice') & is_invoice, amount),
+            ((code_line.type == 'credit') & is_credit, -amount),
+            else_=0)
+        value = Case((code_line.operator == '-', -value), else_=value)
+
+        with Transaction().set_context(periods=list(periods)):
+            where = Tax._amount_where(tax_line, move_line, move)
+        query = (tax_line
+            .join(move_line, condition=tax_line.move_line == move_line.id)
+            .join(move, condition=move_line.move == move.id)
+            .join(code_line, condition=(code_line.tax == tax_line.tax)
+                & (code_line.amount == tax_line.type))
+            .select(code_line.code.as_('code'), move.period.as_('period'),
+                Sum(value).as_('amount'),
+                where=reduce_ids(code_line.code, code_ids)
+                & (move_line.state != 'draft')
+                & where,
+                group_by=[code_line.code, move.period]))
+        if backend.name == 'sqlite':
+            sqlite_apply_types(query, [None, None, 'NUMERIC'])
+        cursor.execute(*query)
+        return {(code_id, period_id): Decimal(amount or 0)
+            for code_id, period_id, amount in cursor}
+
+    @classmethod
+    def get_calculation_fingerprints(cls, periods_list, plan, prorrata):
+        '''
+        Return a fingerprint of the inputs of the calculation for each list
+        of periods of periods_list.
+
+        It covers the number and the last modification of the tax lines of
+        the periods, the tax codes of the mapping plan with their children
+        and code lines, the mapping plan and the prorrata configuration.
+        '''
+        pool = Pool()
+        TaxLine = pool.get('account.tax.line')
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        cursor = Transaction().connection.cursor()
+        tax_line = TaxLine.__table__()
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+
+        period_ids = set(p for periods in periods_list for p in periods)
+        stats = {}
+        for sub_ids in grouped_slice(period_ids):
+            cursor.execute(*tax_line.join(move_line,
+                    condition=tax_line.move_line == move_line.id
+                    ).join(move,
+                    condition=move_line.move == move.id
+                    ).select(move.period, Count(tax_line.id),
+                    Max(tax_line.create_date), Max(tax_line.write_date),
+                    Max(move_line.write_date),
+                    where=reduce_ids(move.period, sub_ids),
+                    group_by=move.period))
+            for row in cursor:
+                stats[row[0]] = tuple(str(x) for x in row[1:])
+
+        code_stats = cls.get_tax_code_stats(
+            set(plan['code']) | set(plan['exonerated390']))
+
+        plan_key = json.dumps(dict(plan), sort_keys=True,
+            default=lambda o: dict(o) if hasattr(o, 'items') else str(o))
+
+        fingerprints = []
+        for periods in periods_list:
+            periods = sorted(periods)
+            key = (periods, [stats.get(p) for p in periods], code_stats,
+                plan_key, prorrata)
+            fingerprints.append(
+                hashlib.sha256(repr(key).encode('utf-8')).hexdigest())
+        return fingerprints
+
+    @classmethod
+    def get_tax_code_stats(cls, code_ids):
+        '''
+        Return the parent, the last modification and the stats of the code
+        lines of the tax codes and all their children.
+
+        The amount of a tax code is computed over its whole tree so any
+        change of its children or of their code lines changes its amount.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        TaxCodeLine = pool.get('account.tax.code.line')
+        cursor = Transaction().connection.cursor()
+        code_line = TaxCodeLine.__table__()
+
+        if not code_ids:
+            return ()
+        codes = TaxCode.search([
+                ('parent', 'child_of', list(code_ids)),
+                ], order=[('id', 'ASC')])
+        line_stats = {}
+        for sub_ids in grouped_slice([c.id for c in codes]):
+            cursor.execute(*code_line.select(code_line.code,
+                    Count(code_line.id), Max(code_line.create_date),
+                    Max(code_line.write_date),
+                    where=reduce_ids(code_line.code, sub_ids),
+                    group_by=code_line.code))
+            for row in cursor:
+                line_stats[row[0]] = tuple(str(x) for x in row[1:])
+        return tuple((c.id, c.parent.id if c.parent else None,
+                str(c.write_date), line_stats.get(c.id)) for c in codes)
+
+    @classmethod
+    def run_task(cls, reports, method):
+        '''
+        Run method on the reports from a queue task by committed chunks.
+
+        The user errors are only stored on their reports and the first
+        unexpected error is raised once all the reports are run.
+        '''
+        running, previous = {
+            '_calculate': ('calculating', 'draft'),
+            '_process': ('processing', 'calculated'),
+            }[method]
+        # The reports already run by a previous attempt of the task are
+        # skipped
+        ids = [r.id for r in reports if r.state == running]
+        exceptions = [e for e in cls._run_chunks(ids, method, previous)
+            if not isinstance(e, (UserError, UserWarning))]
+        if exceptions:
+            raise exceptions[0]
+
+    @classmethod
+    def run_chunks(cls, reports, method):
+        '''
+        Run method on the reports by committed chunks.
+
+        The first error is raised once all the reports are run, the
+        changes of the succeeded chunks are kept.
+        '''
+        exceptions = cls._run_chunks([r.id for r in reports], method)
+        if exceptions:
+            raise exceptions[0]
+
+    @classmethod
+    def _run_chunks(cls, ids, method, previous=None):
+        '''
+        Run method on the reports by chunks of BATCH_SIZE reports, each one
+        committed on its own transaction after committing the previous
+        changes of the transaction.
+
+        When a chunk fails its reports are run one by one so only the
+        failing reports are rolled back and store the error. Return the
+        exceptions of the failing reports.
+
+        The operational errors of the database and the transaction errors
+        are raised at once without storing them so the whole run is retried.
+        '''
+        Transaction().commit()
+        exceptions = []
+        for sub_ids in grouped_slice(ids, BATCH_SIZE):
+            sub_ids = list(sub_ids)
+            if len(sub_ids) > 1 and cls._run_chunk(sub_ids, method, previous):
+                continue
+            for id_ in sub_ids:
+                try:
+                    cls._run_chunk([id_], method, previous)
+                except _RETRY_EXCEPTIONS:
+                    raise
+                except Exception as exception:
+                    exceptions.append(exception)
+        return exceptions
+
+    @classmethod
+    def _run_chunk(cls, ids, method, previous=None):
+        '''
+        Run method on the reports, store the duration and commit.
+        If it fails, the changes are rolled back and, for a single report,
+        it returns to the previous state if any and the error is stored
+        before raising it.
+        Return True if it succeeded.
+        '''
+        transaction = Transaction()
+        started = time.monotonic()
+        try:
+            getattr(cls, method)(cls.browse(ids))
+        except Exception as exception:
+            transaction.rollback()
+            if isinstance(exception, _RETRY_EXCEPTIONS):
+                raise
+            if len(ids) > 1:
+                return False
+            if isinstance(exception, (UserError, UserWarning)):
+                error = '\n'.join(filter(None,
+                        [exception.message, exception.description]))
+            else:
+                error = ''.join(traceback.format_exception_only(
+                        type(exception), exception)).strip()
+            values = {
+                'duration': datetime.timedelta(
+                    seconds=time.monotonic() - started),
+                'error': error,
+                }
+            if previous:
+                values['state'] = previous
+            cls.write(cls.browse(ids), values)
+            transaction.commit()
+            raise
+        cls.write(cls.browse(ids), {
+                'duration': datetime.timedelta(
+                    seconds=time.monotonic() - started),
+                'error': None,
+                })
+        transaction.commit()
+        return True
+
+    @classmethod
+    def queue_task(cls, reports, method):
+        'Enqueue a task to run method for the reports of each company'
+        reports_by_company = {}
+        for report in reports:
+            reports_by_company.setdefault(report.company, []).append(report)
+        for company_reports in reports_by_company.values():
+            cls.__queue__.run_task(company_reports, method)
+
+    @classmethod
+    @ModelView.button
+    def force_calculate(cls, reports):
+        with Transaction().set_context(aeat303_force_calculation=True):
+            cls.calculate(reports)
+
     @classmethod
     @ModelView.button
-    @Workflow.transition('calculated')
     def calculate(cls, reports):
+        '''
+        Calculate the reports in a queue task or by committed chunks so a
+        failing report does not roll back the others
+        '''
+        if QUEUE_TASKS:
+            cls.calculating(reports)
+        else:
+            cls.run_chunks(reports, '_calculate')
+
+    @classmethod
+    @Workflow.transition('calculating')
+    def calculating(cls, reports):
+        cls.write(reports, {'error': None})
+        cls.queue_task(reports, '_calculate')
+
+    @classmethod
+    @Workflow.transition('calculated')
+    def _calculate(cls, reports):
         pool = Pool()
         Mapping = pool.get('aeat.303.mapping')
         Period = pool.get('account.period')
-        TaxCode = pool.get('account.tax.code')
         Config = pool.get('account.configuration')
         FiscalYear = pool.get('account.fiscalyear')
 
         config = Config(1)
         prorrata = config.aeat303_prorrata_percent
-        prorrata_difference = 0
+        force = Transaction().context.get('aeat303_force_calculation')
 
-        # Excluded fields use to be numeric, but are now const in regards to
-        # the aeat 303 file
-        excluded_fields = ['accrued_vat_percent_4', 'accrued_vat_percent_5',
-                           'accrued_re_percent_1']
-
-        deductible_fields = ['deductible_current_domestic_operations_tax',
-                             'deductible_investment_domestic_operations_tax',
-                             'deductible_regularization_tax']
+        deductible_fields = _DEDUCTIBLE_FIELDS
         prorrata_reg_field = 'deductible_pro_rata_regularization'
+
+        reports_by_company = {}
         for report in reports:
-            mapping = {}
-            mapping_exonerated390 = {}
-            fixed = {}
-            for mapp in Mapping.search([
-                    ('type_', '=', 'code'),
-                    ('company', '=', report.company),
-                    ]):
-                for code in mapp.code_by_companies:
-                    mapping.setdefault(code.id, []).append(
-                        mapp.aeat303_field.name)
-            for mapp in Mapping.search([
-                    ('type_', '=', 'exonerated390'),
-                    ('company', '=', report.company),
-                    ]):
-                for code in mapp.code_by_companies:
-                    mapping_exonerated390[code.id] = mapp.aeat303_field.name
-            for mapp in Mapping.search([
-                    ('type_', '=', 'numeric'),
-                    ('company', '=', report.company),
-                    ('aeat303_field.name', 'not in', excluded_fields),
-                    ]):
-                fixed[mapp.aeat303_field.name] = mapp.number
+            reports_by_company.setdefault(report.company, []).append(report)
+
+        calculated = []
+
+        for company, company_reports in reports_by_company.items():
+            plan = Mapping.get_mapping_plan(company)
+            mapping = plan['code']
+            mapping_exonerated390 = plan['exonerated390']
+            fixed = plan['numeric']
 
             if len(fixed) == 0:
                 raise UserError(gettext('aeat_303.msg_no_config'))
 
-            year = report.year
-            periods = report.get_periods()
-
-            if prorrata:
-                report.prorrata_percent_applied = prorrata
-                if report.period in ['12', '4T']:
-                    fiscalyear = FiscalYear.find(report.company,
-                        date=datetime.date(year, 12, 31), test_state=False)
-                    prorrata_real_percent = config._calculate_prorrata(
-                        fiscalyear=fiscalyear)
-                    prorrata_difference = (prorrata_real_percent - prorrata)
-                    report.prorrata_real_percent = prorrata_real_percent
-
-            for field, value in fixed.items():
-                setattr(report, field, value)
-            for mapped_fields in mapping.values():
-                for field in mapped_fields:
+            deductible_codes = plan['deductible']
+
+            report_periods = []
+            for report in company_reports:
+                periods = [report.get_periods()]
+                if report.period in ('12', '4T'):
+                    year = report.year
+                    periods.append([p.id for p in Period.search([
+                                ('start_date', '>=',
+                                    datetime.date(year, 1, 1)),
+                                ('end_date', '<=',
+                                    datetime.date(year, 12, 31)),
+                                ('company', '=', company),
+                                ])])
+                report_periods.append(periods)
+
+            # Skip the reports whose inputs did not change since they were
+            # calculated
+            fingerprints = cls.get_calculation_fingerprints(
+                [sum(periods, []) for periods in report_periods], plan,
+                prorrata)
+            to_calculate = []
+            for report, periods, fingerprint in zip(
+                    company_reports, report_periods, fingerprints):
+                if (not force and report.calculation_date
+                        and report.calculation_fingerprint == fingerprint):
+                    continue
+                report.calculation_fingerprint = fingerprint
+                to_calculate.append((report, periods))
+            if not to_calculate:
+                continue
+            company_reports = [r for r, _ in to_calculate]
+            calculated.extend(company_reports)
+
+            # Compute the amounts of all the reports of the company at once
+            periods_list = sum((periods for _, periods in to_calculate), [])
+            amounts_list = iter(cls.get_tax_code_amounts_by_periods(
+                    list(mapping.keys()) + list(mapping_exonerated390.keys()),
+                    periods_list, company.currency))
+
+            for report in company_reports:
+                year = report.year
+                prorrata_difference = 0
+                if prorrata:
+                    report.prorrata_percent_applied = prorrata
+                    if report.period in ['12', '4T']:
+                        fiscalyear = FiscalYear.find(report.company,
+                            date=datetime.date(year, 12, 31),
+                            test_state=False)
+                        prorrata_real_percent = config._calculate_prorrata(
+                            fiscalyear=fiscalyear)
+                        prorrata_difference = (
+                            prorrata_real_percent - prorrata)
+                        report.prorrata_real_percent = prorrata_real_percent
+
+                for field, value in fixed.items():
+                    setattr(report, field, value)
+                for mapped_fields in mapping.values():
+                    for field in mapped_fields:
+                        setattr(report, field, Decimal(0))
+                for field in mapping_exonerated390.values():
                     setattr(report, field, Decimal(0))
-            for field in mapping_exonerated390.values():
-                setattr(report, field, Decimal(0))
-            for field in deductible_fields:
-                setattr(report, 'preprorrata_' + field, Decimal(0))
-
-            with Transaction().set_context(periods=periods):
-                code_ids = list(mapping.keys())
-                for tax, code_id in zip(TaxCode.browse(code_ids), code_ids):
-                    for field in mapping[code_id]:
+                for field in deductible_fields:
+                    setattr(report, 'preprorrata_' + field, Decimal(0))
+
+                amounts = next(amounts_list)
+                for code_id, mapped_fields in mapping.items():
+                    for field in mapped_fields:
                         value = getattr(report, field)
-                        amount = (value or 0) + tax.amount
+                        amount = (value or 0) + amounts[code_id]
                         if field in deductible_fields and prorrata:
                             value = getattr(report, 'preprorrata_' + field)
-                            amount = (value or 0) + tax.amount
+                            amount = (value or 0) + amounts[code_id]
                             setattr(report, field,
                                 amount - report.currency.round(
                                     amount * Decimal(1 - prorrata / 100)))
@@ -1843,55 +2905,76 @@ class Report(Workflow, ModelSQL, ModelView):
                         else:
                             setattr(report, field, amount)
 
-            prorrata_regularization = 0
-            if report.period in ('12', '4T'):
-                periods = [p.id for p in Period.search([
-                        ('start_date', '>=', datetime.date(year, 1, 1)),
-                        ('end_date', '<=', datetime.date(year, 12, 31)),
-                        ('company', '=', report.company),
-                        ])]
-                with Transaction().set_context(periods=periods):
-                    for tax in TaxCode.browse(
-                            mapping_exonerated390.keys()):
-                        value = getattr(
-                            report, mapping_exonerated390[tax.id])
-                        amount = (value or 0) + tax.amount
-                        setattr(report, mapping_exonerated390[tax.id],
-                            amount)
+                prorrata_regularization = 0
+                if report.period in ('12', '4T'):
+                    amounts = next(amounts_list)
+                    for code_id, field in mapping_exonerated390.items():
+                        value = getattr(report, field)
+                        amount = (value or 0) + amounts[code_id]
+                        setattr(report, field, amount)
                     if prorrata_difference:
-                        for tax in TaxCode.browse([key for key, val in
-                                    mapping.items()
-                                    if any(field in deductible_fields
-                                        for field in val)]):
-                            prorrata_regularization += (report.currency.round(
-                                    tax.amount * Decimal(
-                                        prorrata_difference/100)))
-            if prorrata_regularization:
-                setattr(report, prorrata_reg_field, prorrata_regularization)
-            report.save()
-
-        cls.write(reports, {
-                'calculation_date': datetime.datetime.now(),
-                })
+                        for code_id in deductible_codes:
+                            prorrata_regularization += (
+                                report.currency.round(amounts[code_id]
+                                    * Decimal(prorrata_difference/100)))
+                if prorrata_regularization:
+                    setattr(report, prorrata_reg_field,
+                        prorrata_regularization)
+        if calculated:
+            cls.save(calculated)
+            cls.write(calculated, {
+                    'calculation_date': datetime.datetime.now(),
+                    })
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('done')
     def process(cls, reports):
+        '''
+        Process the reports in a queue task or by committed chunks so a
+        failing report does not roll back the others
+        '''
+        if QUEUE_TASKS:
+            cls.processing(reports)
+        else:
+            cls.run_chunks(reports, '_process')
+
+    @classmethod
+    @Workflow.transition('processing')
+    def processing(cls, reports):
+        cls.write(reports, {'error': None})
+        cls.queue_task(reports, '_process')
+
+    @classmethod
+    @Workflow.transition('done')
+    def _process(cls, reports):
         pool = Pool()
         Move = pool.get('account.move')
         Period = pool.get('account.period')
+        Balance = pool.get('aeat.303.tax.code.balance')
 
+        to_post, to_close, to_update = set(), set(), set()
         for report in reports:
             report.create_file()
             report.create_move()
             report.set_prorrata_percent_config(report.year)
+            periods = report.get_periods()
             # Means that we have to post the move created and close the
             # period or periods related.
             if report.move and report.post_and_close:
-                periods = report.get_periods()
-                Move.post([report.move])
-                Period.close(Period.browse(periods))
+                to_post.add(report.move.id)
+                to_close.update(periods)
+            to_update.update(periods)
+
+        # Post and close for all the reports at once locking the periods
+        # always in the same order to prevent deadlocks
+        to_close = Period.browse(sorted(to_close))
+        if to_close:
+            Period.lock(to_close)
+        if to_post:
+            Move.post(Move.browse(sorted(to_post)))
+        if to_close:
+            Period.close(to_close)
+        Balance.update(Period.browse(sorted(to_update)))
 
     @classmethod
     @ModelView.button
@@ -1899,21 +2982,30 @@ class Report(Workflow, ModelSQL, ModelView):
     def cancel(cls, reports):
         pool = Pool()
         Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        cursor = Transaction().connection.cursor()
+        line = MoveLine.__table__()
+
+        to_update = [r for r in reports if r.move]
+        moves = [r.move for r in to_update]
+        move_ids = [m.id for m in moves]
+
+        # Check the reconciled lines of all the moves at once
+        reconciled = set()
+        for sub_ids in grouped_slice(move_ids):
+            cursor.execute(*line.select(line.move,
+                    where=reduce_ids(line.move, sub_ids)
+                    & (line.reconciliation != Null),
+                    group_by=line.move))
+            reconciled.update(m for m, in cursor)
+        if reconciled:
+            raise UserError(gettext('aeat_303.msg_not_possible_cancel',
+                    report=', '.join(str(r.id) for r in to_update
+                        if r.move.id in reconciled)))
 
-        to_update = []
         for report in reports:
             report.set_prorrata_percent_config(report.year - 1)
-            move = report.move
-            if not move:
-                continue
-            for line in move.lines:
-                if line.reconciliation is not None:
-                    raise UserError(
-                        gettext('aeat_303.msg_not_possible_cancel',
-                            report=report.id))
-            to_update.append(report)
         if to_update:
-            moves = [x.move for x in to_update]
             Move.draft(moves)
             Move.delete(moves)
             cls.write(to_update, {'move': None,})
@@ -1924,78 +3016,302 @@ class Report(Workflow, ModelSQL, ModelView):
     def draft(cls, reports):
         pass
 
+    @classmethod
+    def get_file_routing(cls):
+        '''
+        Return the columns of the report written in the file with the indexes
+        of the records of the file where each one is set.
+
+        The routing is computed once per class from the record definitions.
+        '''
+        routing = cls.__dict__.get('_file_routing')
+        if routing is None:
+            records = [Record(d)._fields for d in _FILE_RECORDS]
+            routing = []
+            for column in cls._fields:
+                if column in _FILE_EXCLUDED_COLUMNS:
+                    continue
+                indexes = tuple(i for i, fields in enumerate(records)
+                    if column in fields)
+                if indexes:
+                    routing.append((column, indexes))
+            routing = cls._file_routing = tuple(routing)
+        return routing
+
+    @classmethod
+    def get_file_parser(cls):
+        '''
+        Return for each record of the file its length, its constant fields
+        and the report columns read from it with their position and field.
+
+        It is the inverse of the routing of the file: each stored column is
+        read from the first record where it is written.
+        '''
+        parser = cls.__dict__.get('_file_parser')
+        if parser is None:
+            records = [Record(d) for d in _FILE_RECORDS]
+            columns = dict((column, indexes[0])
+                for column, indexes in cls.get_file_routing()
+                if not isinstance(cls._fields[column], fields.Function))
+            parser = []
+            for index, (definition, record) in enumerate(
+                    zip(_FILE_RECORDS, records)):
+                consts, fields_ = [], []
+                for start, length, name, _ in definition:
+                    field = record._fields[name]
+                    position = (start - 1, start - 1 + length)
+                    if isinstance(field, Const):
+                        consts.append(position + (field,))
+                    elif columns.get(name) == index:
+                        fields_.append((name,) + position + (field,))
+                length = max(s + l - 1 for s, l, _, _ in definition)
+                parser.append((length, tuple(consts), tuple(fields_)))
+            parser = cls._file_parser = tuple(parser)
+        return parser
+
     def create_file(self):
-        header = Record(aeat303.HEADER_RECORD)
-        footer = Record(aeat303.FOOTER_RECORD)
-        record = Record(aeat303.RECORD)
-        general_record = Record(aeat303.GENERAL_RECORD)
+        self.file_ = self.__class__.file_.cast(self.get_file_data())
+        self.save()
+
+    @classmethod
+    def export_files(cls, reports):
+        '''
+        Return a ZIP archive with the files of the reports.
+
+        The file of each report is generated and written to the archive one by
+        one in a temporary file. The entries are named by company VAT, year and
+        period, and the id of the report is added on collision.
+        The archive is returned whole so at most EXPORT_LIMIT reports can be
+        exported at once.
+        '''
+        if EXPORT_LIMIT and len(reports) > EXPORT_LIMIT:
+            raise UserError(gettext('aeat_303.msg_export_files_limit',
+                    count=len(reports), limit=EXPORT_LIMIT))
+        names = set()
+        with tempfile.TemporaryFile() as file_:
+            with zipfile.ZipFile(file_, 'w',
+                    compression=zipfile.ZIP_DEFLATED) as archive:
+                for report in reports:
+                    name = 'aeat303-%s-%s-%s' % (
+                        report.company_vat or report.company.id,
+                        report.year, report.period)
+                    if name in names:
+                        name += '-%s' % report.id
+                    names.add(name)
+                    archive.writestr(name + '.txt', report.get_file_data())
+            file_.seek(0)
+            return cls.file_.cast(file_.read())
+
+    @classmethod
+    def parse_file(cls, data, name=None):
+        '''
+        Return the values of the report columns read from the file data
+        '''
+        text = data.decode('iso-8859-1').rstrip('\r\n')
+        parser = cls.get_file_parser()
+        values = {}
+        try:
+            if len(text) != sum(length for length, _, _ in parser):
+                raise AssertionError('Invalid length of file "%s".'
+                    % len(text))
+            offset = 0
+            for length, consts, fields_ in parser:
+                line = text[offset:offset + length]
+                offset += length
+                for start, end, field in consts:
+                    field.set_from_file(line[start:end])
+                for column, start, end, field in fields_:
+                    value = line[start:end]
+                    if isinstance(field, Date) and not value.strip():
+                        value = None
+                    else:
+                        value = field.get(field.set_from_file(value))
+                    values[column] = value
+        except (AssertionError, RetrofixException) as e:
+            raise UserError(gettext('aeat_303.msg_invalid_file',
+                    file=name or '', error=str(e)))
+
+        for column, value in values.items():
+            field = cls._fields[column]
+            if field._type == 'integer':
+                values[column] = int(value) if value.strip() else None
+            elif field._type == 'char':
+                values[column] = value.rstrip() or None
+            elif field._type == 'selection' and isinstance(value, str):
+                keys = {k for k, _ in field.selection}
+                if value not in keys:
+                    values[column] = value.strip() or None
+        return values
+
+    @classmethod
+    def verify_files(cls, reports):
+        '''
+        Return for each report the mismatches of its regenerated file
+
+        The regenerated file is compared field by field with the stored file
+        and the values parsed from it with the report columns. Each mismatch
+        is a tuple of the source, the name and the expected and found values.
+        '''
+        parser = cls.get_file_parser()
+        positions = []
+        offset = 0
+        for definition in _FILE_RECORDS:
+            length = max(s + l - 1 for s, l, _, _ in definition)
+            for start, size, name, _ in definition:
+                positions.append(
+                    (name, offset + start - 1, offset + start - 1 + size))
+            offset += length
+        sizes = dict((column, end - start)
+            for _, _, fields_ in parser
+            for column, start, end, _ in fields_)
+
+        result = {}
+        for report in reports:
+            mismatches = result[report.id] = []
+            try:
+                data = report.get_file_data()
+                values = cls.parse_file(data, report.rec_name)
+            except UserError as e:
+                mismatches.append(('error', None, None, e.message))
+                continue
+
+            stored = report.file_
+            if stored is None:
+                mismatches.append(('file', None, None, None))
+            elif bytes(stored) != data:
+                if len(stored) != len(data):
+                    mismatches.append(
+                        ('file', None, len(stored), len(data)))
+                for name, start, end in positions:
+                    if stored[start:end] != data[start:end]:
+                        mismatches.append(('file', name,
+                                bytes(stored[start:end]).decode('iso-8859-1'),
+                                data[start:end].decode('iso-8859-1')))
+
+            for column, found in values.items():
+                expected = getattr(report, column)
+                if not expected:
+                    if found:
+                        mismatches.append(
+                            ('column', column, expected, found))
+                    continue
+                if column == 'year':
+                    expected = int(expected)
+                elif cls._fields[column]._type == 'char':
+                    expected = encode_file(expected).decode(
+                        'iso-8859-1')[:sizes[column]].rstrip() or None
+                if expected != found:
+                    mismatches.append(('column', column, expected, found))
+        return result
+
+    @classmethod
+    def import_files(cls, company, files):
+        '''
+        Create done reports of the company from the files given as pairs of
+        name and data.
+
+        The files are parsed while they are read and the reports are created
+        in batches.
+        '''
+        def values():
+            for name, data in files:
+                yield dict(cls.parse_file(data, name),
+                    company=company.id,
+                    state='done',
+                    file_=data)
+
+        reports = []
+        for sub_values in grouped_slice(values()):
+            reports.extend(cls.create(list(sub_values)))
+        return reports
+
+    @classmethod
+    def get_import_files(cls, data, name=None):
+        '''
+        Yield the name and data of the files of a ZIP archive or the file
+        itself
+        '''
+        if zipfile.is_zipfile(io.BytesIO(data)):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield info.filename, archive.read(info)
+        else:
+            yield name, data
+
+    @classmethod
+    def import_directory(cls, company, path):
+        '''
+        Create done reports of the company from the files and ZIP archives
+        of the directory
+        '''
+        def files():
+            for root, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    with open(os.path.join(root, name), 'rb') as file_:
+                        data = file_.read()
+                    yield from cls.get_import_files(data, name)
+        return cls.import_files(company, files())
+
+    def get_file_data(self):
+        '''
+        Return the content of the AEAT 303 file of the report
+        '''
+        records = [Record(d) for d in _FILE_RECORDS]
+        header, record, general_record, bank_data_record, footer = records
         # annual_resume_record = Record(aeat303.ANNUAL_RESUME_RECORD)
         # annual_additional_record = Record(
         #    aeat303.ANNUAL_RESUME_ADDITIONAL_RECORD)
-        bank_data_record = Record(aeat303.BANK_DATA_RECORD)
 
         # Set fix values for Version and Company VAT
         setattr(header, 'program_version', VERSION)
         setattr(header, 'development_company_vat', NIF)
 
-        #These fields use to be numeric, but are now const in regards to the aeat 303 file
-        #(excluding report and bank_account, which were there already)
-        excluded_columns= ['accrued_vat_percent_4', 'accrued_vat_percent_5',
-                           'accrued_re_percent_1', 'report', 'bank_account']
-        columns = [x for x in self.__class__._fields if x not in
-            excluded_columns]
-        for column in columns:
-            value = getattr(self, column, None)
+        routing = self.get_file_routing()
+        values, = self.__class__.read([self.id],
+            [column for column, _ in routing])
+        for column, indexes in routing:
+            value = values[column]
             if not value:
                 continue
             if column == 'year':
-                value = str(self.year)
-            if column in header._fields:
-                setattr(header, column, value)
-            if column in record._fields:
-                setattr(record, column, value)
-            if column in general_record._fields:
-                setattr(general_record, column, value)
-            # If period is diffenret of 12/4T the 4 and 5 page will be without
-            #   content.
-            ## if self.period in ('12', '4T'):
-            ##     if column in annual_resume_record._fields:
-            ##         setattr(annual_resume_record, column, value)
-            ##     if column in annual_additional_record._fields:
-            ##         setattr(annual_additional_record, column, value)
-            if column in bank_data_record._fields:
-                setattr(bank_data_record, column, value)
-            if column in footer._fields:
-                setattr(footer, column, value)
+                value = str(value)
+            for index in indexes:
+                setattr(records[index], column, value)
         record.bankruptcy = bool(self.auto_bankruptcy_declaration != ' ')
         bank_data_record.bank_account = next((n.number_compact
                 for n in self.bank_account.numbers
                 if n.type == 'iban'), '') if self.bank_account else ''
+        # If period is diffenret of 12/4T the 4 and 5 page will be without
+        #   content.
         ## if self.period in ('12', '4T'):
         ##     records = [header, record, general_record, annual_resume_record,
-        ##         annual_additional_record, bank_data_record]
-        ## else:
-        ##     records = [header, record, general_record, bank_data_record]
-        records = [header, record, general_record, bank_data_record]
-        records.append(footer)
+        ##         annual_additional_record, bank_data_record, footer]
         try:
             data = retrofix_write(records, separator='')
         except AssertionError as e:
             raise UserError(str(e))
-        data = remove_accents(data).upper()
-        if isinstance(data, str):
-            data = data.encode('iso-8859-1', errors='ignore')
-        self.file_ = self.__class__.file_.cast(data)
-        self.save()
+        return encode_file(data)
 
     def create_move(self):
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        values = self.get_move_values()
+        if not values:
+            return
+        self.move, = Move.create([values])
+        self.save()
+
+    def get_move_values(self):
+        '''
+        Return the values to create the AEAT303 move with its lines or None
+        if the move is not required.
+        '''
         pool = Pool()
         Mapping = pool.get('aeat.303.mapping')
         TaxCode = pool.get('account.tax.code')
-        Tax = pool.get('account.tax')
-        TaxLine = pool.get('account.tax.line')
-        Move = pool.get('account.move')
-        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
         Config = pool.get('account.configuration')
 
         # If this two fields are not set, means not required to create
@@ -2005,123 +3321,186 @@ class Report(Workflow, ModelSQL, ModelView):
 
         prorrata_account = Config(1).aeat303_prorrata_account
 
-        codes = []
         # Get all the codes from AEAT303 Mapping table.
-        for mapp in Mapping.search([
-                ('type_', '=', 'code'),
-                ('company', '=', self.company),
-                ]):
-            codes.extend((x.id for x in mapp.code_by_companies))
+        codes = list(Mapping.get_mapping_plan(self.company)['code'].keys())
         if not codes:
             return
         periods = self.get_periods()
         description = self.move_description or 'AEAT 303'
         with Transaction().set_context(periods=periods):
-            mapp_code_lines = {}
-            for code in TaxCode.browse(codes):
-                if not code.amount:
-                    continue
+            amounts = self.get_move_line_amounts(codes, periods)
+        if not amounts:
+            return
+        names = {c.id: c.name
+            for c in TaxCode.browse(list({c for c, _ in amounts}))}
 
-                # To create the AEAT303 account move need the last level of a
-                # code tree, so search all the child of the code and us only
-                # the child without childs, last level.
-                children = []
-                childs = TaxCode.search([
-                        ('parent', 'child_of', [code]),
-                        ])
-                if len(childs) == 1:
-                    children = childs
-                else:
-                    for child in childs:
-                        if not child.childs and child.amount:
-                            children.append(child)
-                # Only create the domain for the tax codes that are "Tax",
-                # not "Base".
-                # With that doamin, get the related account tax lines, to get
-                # the related account move, so could be done the counterpart
-                # account move.
-                for child in children:
-                    if not child.lines:
-                        continue
-                    domain = [['OR'] + [x._line_domain for x in child.lines
-                        if x.amount == 'tax']]
-                    if domain == [['OR']]:
-                        continue
-                    #domain += Tax._amount_domain()
-                    domain.extend(Tax._amount_domain())
-                    tax_lines = TaxLine.search(domain)
-                    mapp_code_lines[child] = [x.move_line for x in tax_lines]
-            if not mapp_code_lines:
-                return
-
-            # Create the AET303 move with the move lines obtained fron tax
-            # code.
-            move = Move()
-            move.journal = self.move_journal
-            move.period = periods[-1]
-            move.date = move.period.end_date
-            move.origin = self
-            move.state = 'draft'
-            move.description = description
-            move.save()
-
-            move_lines = {}
-            for code, lines in mapp_code_lines.items():
-                for line in lines:
-                    key = (code, line.account)
-                    if key in move_lines:
-                        move_lines[key].credit += line.debit
-                        move_lines[key].debit += line.credit
-                    else:
-                        move_line = MoveLine()
-                        move_line.move = move
-                        move_line.account = line.account
-                        move_line.credit = line.debit
-                        move_line.debit = line.credit
-                        move_line.description = code.name
-                        # TODO: Control if analytic exist
-                        move_lines[key] = move_line
-        counterpart_line = MoveLine()
-        counterpart_line.move = move
-        counterpart_line.account = self.move_account
-        counterpart_amount = self.get_move_counterpart_amount()
-        if counterpart_amount >= 0:
-            counterpart_line.credit = counterpart_amount
-            counterpart_line.debit = _Z
-        else:
-            counterpart_line.debit = -1 * counterpart_amount
-            counterpart_line.credit = _Z
-        counterpart_line.description = description
-        # Ensure that all the moves are set only the debit or credit,
-        # not both either 0 on both.
+        # Create the AET303 move lines obtained from tax code ensuring that
+        # all the lines are set only the debit or credit, not both either 0
+        # on both.
         lines = []
-        for key, line in move_lines.items():
-            if line.debit and line.credit:
-                balance = line.debit - line.credit
+        for (code_id, account_id), (debit, credit) in amounts.items():
+            # The counterpart of the tax lines
+            debit, credit = credit, debit
+            if debit and credit:
+                balance = debit - credit
                 if balance == _Z:
                     continue
                 elif balance >= _Z:
-                    line.debit = balance
-                    line.credit = _Z
+                    debit, credit = balance, _Z
                 else:
-                    line.credit = -balance
-                    line.debit = _Z
-            lines.append(line)
-        lines_to_save = lines + [counterpart_line]
+                    debit, credit = _Z, -balance
+            # TODO: Control if analytic exist
+            lines.append({
+                    'account': account_id,
+                    'debit': debit,
+                    'credit': credit,
+                    'description': names[code_id],
+                    })
+        counterpart_amount = self.get_move_counterpart_amount()
+        if counterpart_amount >= 0:
+            debit, credit = _Z, counterpart_amount
+        else:
+            debit, credit = -1 * counterpart_amount, _Z
+        lines.append({
+                'account': self.move_account.id,
+                'debit': debit,
+                'credit': credit,
+                'description': description,
+                })
         debit = self.calculate_prorrata_debit()
         if debit and prorrata_account:
-            prorrata_line = MoveLine()
-            prorrata_line.move = move
-            prorrata_line.account = prorrata_account
-            prorrata_line.debit = debit
-            prorrata_line.credit = _Z
-            prorrata_line.description = gettext(
-                'aeat_303.msg_prorrata_regularization')
-            lines_to_save.append(prorrata_line)
-
-        MoveLine.save(lines_to_save)
-        self.move = move
-        self.save()
+            lines.append({
+                    'account': prorrata_account.id,
+                    'debit': debit,
+                    'credit': _Z,
+                    'description': gettext(
+                        'aeat_303.msg_prorrata_regularization'),
+                    })
+
+        period = Period(periods[-1])
+        return {
+            'company': self.company.id,
+            'journal': self.move_journal.id,
+            'period': period.id,
+            'date': period.end_date,
+            'origin': str(self),
+            'state': 'draft',
+            'description': description,
+            'lines': [('create', lines)],
+            }
+
+    def get_move_codes(self, codes, periods):
+        '''
+        Return the last level of the tree of the tax codes used to create
+        the move: the code itself if it has no children or its descendants
+        without children and with amount. The codes without amount are
+        skipped.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        cursor = Transaction().connection.cursor()
+        code = TaxCode.__table__()
+        child = TaxCode.__table__()
+
+        # Fetch the tree of all the codes at once and keep the active ones
+        tree = With('root', 'code', 'parent', recursive=True)
+        tree.query = Union(
+            code.select(code.id, code.id, code.parent,
+                where=reduce_ids(code.id, codes)),
+            child.join(tree, condition=child.parent == tree.code
+                ).select(tree.root, child.id, child.parent),
+            all_=True)
+        cursor.execute(*tree.select(tree.root, tree.code, tree.parent,
+                with_=[tree]))
+        rows = cursor.fetchall()
+        active = set(map(int, TaxCode.search([
+                        ('id', 'in', list({r[1] for r in rows})),
+                        ])))
+        trees, parents = {}, set()
+        for root_id, code_id, parent_id in rows:
+            if code_id not in active:
+                continue
+            trees.setdefault(root_id, []).append(code_id)
+            if code_id != root_id:
+                parents.add(parent_id)
+
+        amounts = self.get_tax_code_amounts(
+            set().union(*trees.values()), periods, self.currency)
+        leaves = []
+        for root_id in codes:
+            if not amounts.get(root_id):
+                continue
+            subtree = trees.get(root_id, [])
+            if len(subtree) == 1:
+                children = subtree
+            else:
+                children = sorted(c for c in subtree
+                    if c not in parents and amounts.get(c))
+            leaves.extend(c for c in children if c not in leaves)
+        return leaves
+
+    def get_move_line_amounts(self, codes, periods):
+        '''
+        Return the debit and credit of the move lines of the tax lines of
+        type tax of the periods grouped by the last level tax code and the
+        account.
+        '''
+        pool = Pool()
+        TaxLine = pool.get('account.tax.line')
+        CodeLine = pool.get('account.tax.code.line')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Tax = pool.get('account.tax')
+        cursor = Transaction().connection.cursor()
+        tax_line = TaxLine.__table__()
+        code_line = CodeLine.__table__()
+        move = Move.__table__()
+        move_line = MoveLine.__table__()
+        line = MoveLine.__table__()
+
+        leaves = self.get_move_codes(codes, periods)
+        if not leaves:
+            return {}
+
+        is_invoice, is_credit = self._get_tax_line_conditions(
+            tax_line, move_line)
+        with Transaction().set_context(periods=periods):
+            where = Tax._amount_where(tax_line, move_line, move)
+        result = {}
+        for sub_ids in grouped_slice(leaves):
+            # Each tax line is counted once for each code even if it
+            # matches many of its code lines
+            code_tax_lines = (tax_line
+                .join(move_line,
+                    condition=tax_line.move_line == move_line.id)
+                .join(move, condition=move_line.move == move.id)
+                .join(code_line, condition=(code_line.tax == tax_line.tax)
+                    & (code_line.amount == tax_line.type))
+                .select(code_line.code.as_('code'),
+                    tax_line.move_line.as_('move_line'),
+                    where=reduce_ids(code_line.code, sub_ids)
+                    & (code_line.amount == 'tax')
+                    & (((code_line.type == 'invoice') & is_invoice)
+                        | ((code_line.type == 'credit') & is_credit))
+                    & where,
+                    group_by=[code_line.code, tax_line.id,
+                        tax_line.move_line]))
+            query = (code_tax_lines
+                .join(line, condition=code_tax_lines.move_line == line.id)
+                .select(code_tax_lines.code.as_('code'),
+                    line.account.as_('account'),
+                    Sum(line.debit).as_('debit'),
+                    Sum(line.credit).as_('credit'),
+                    group_by=[code_tax_lines.code, line.account],
+                    order_by=[code_tax_lines.code, line.account]))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            for code_id, account_id, debit, credit in cursor:
+                result[(code_id, account_id)] = (
+                    self.currency.round(Decimal(debit or 0)),
+                    self.currency.round(Decimal(credit or 0)))
+        return {k: result[k] for c in leaves for k in result if k[0] == c}
 
     def get_move_counterpart_amount(self):
         return self.liquidation_result
@@ -1,12 +1,20 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import hashlib
+from decimal import Decimal
+from trytond.cache import Cache
 from trytond.model import ModelSQL, fields, ModelView
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool
 from trytond.modules.company.model import CompanyValueMixin
+from trytond.tools import reduce_ids
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from sql import Literal, Null
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+from sql.operators import Exists
 from math import ceil
 
 
@@ -48,6 +56,8 @@ class Configuration(metaclass=PoolMeta):
             }))
     aeat303_prorrata_fiscalyear = fields.MultiValue(fields.Many2One(
         'account.fiscalyear', "Prorrata Fiscal Year"))
+    _prorrata_cache = Cache('account.configuration.aeat303_prorrata',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -81,11 +91,10 @@ class Configuration(metaclass=PoolMeta):
 
     def _calculate_prorrata(self, fiscalyear=None):
         pool = Pool()
-        Mapping = pool.get('aeat.303.prorrata.mapping')
-        TaxCode = pool.get('account.tax.code')
+        Mapping = pool.get('aeat.303.mapping')
+        Company = pool.get('company.company')
+        Report = pool.get('aeat.303.report')
         FiscalYear = pool.get('account.fiscalyear')
-        InvoiceLine = pool.get('account.invoice.line')
-        Tax = pool.get('account.tax')
 
         # Won't be really necessary, but with this control ensure that the
         # account is set and that allow th create the account move correctly.
@@ -101,45 +110,170 @@ class Configuration(metaclass=PoolMeta):
             self.save()
         periods = [p.id for p in fiscalyear.periods]
 
-        mapping = {}
-        for map in Mapping.search([('company', '=', company)]):
-            for code in map.code_by_companies:
-                mapping[code.id] = map.prorrata_field.name
+        key = (company, fiscalyear.id,
+            self._get_prorrata_fingerprint(company, periods))
+        prorrata = self._prorrata_cache.get(key)
+        if prorrata is not None:
+            return prorrata
+
+        mapping = Mapping.get_mapping_plan(Company(company))['prorrata']
 
         deductible_import = 0
         total_import = 0
-        with Transaction().set_context(periods=periods):
-            for tax,field in zip(TaxCode.browse(mapping.keys()),
-                                 mapping.values()):
-                total_import += tax.amount
-                #Field refered in the prorrata total amount mapping
-                if field == 'prorrata_total_amount':
-                    continue
-                deductible_import += tax.amount
+        amounts = Report.get_tax_code_amounts(mapping.keys(), periods,
+            Company(company).currency)
+        for code_id, field in mapping.items():
+            total_import += amounts[code_id]
+            #Field refered in the prorrata total amount mapping
+            if field == 'prorrata_total_amount':
+                continue
+            deductible_import += amounts[code_id]
 
         # account_es no longer uses dedicated non-deductible taxes/templates.
         # For purchase lines with deductible rate 0, include the full VAT base
         # in the prorrata denominator as the old iva_no_ded_22 code did.
-        non_deductible_lines = InvoiceLine.search([
-                ('invoice.company', '=', company),
-                ('invoice.state', 'in', ['posted', 'paid']),
-                ('invoice.move.period', 'in', periods),
-                ('invoice.type', '=', 'in'),
-                ('type', '=', 'line'),
-                ('taxes_deductible_rate', '=', 0),
-                ])
-        with Transaction().set_context(_deductible_rate=1):
-            for line in non_deductible_lines:
-                for tax_line in line._get_taxes().values():
-                    tax = Tax(tax_line.tax)
-                    if tax.tax_kind == 'vat':
-                        total_import += tax_line.base
-                        break
+        total_import += self._get_prorrata_non_deductible_base(
+            company, periods)
         prorrata = (ceil((deductible_import/total_import) * 100)
                     if total_import else 0)
 
+        self._prorrata_cache.set(key, prorrata)
         return prorrata
 
+    @classmethod
+    def _get_prorrata_fingerprint(cls, company, periods):
+        '''
+        Return a fingerprint of the inputs of the prorrata of the periods.
+
+        It extends the fingerprint of the 303 calculation with the prorrata
+        tax codes with their children and code lines, the supplier invoice
+        lines of the periods and the taxes of the company.
+        '''
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Company = pool.get('company.company')
+        Report = pool.get('aeat.303.report')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Move = pool.get('account.move')
+        Tax = pool.get('account.tax')
+        cursor = Transaction().connection.cursor()
+        invoice = Invoice.__table__()
+        line = InvoiceLine.__table__()
+        move = Move.__table__()
+        tax = Tax.__table__()
+
+        plan = Mapping.get_mapping_plan(Company(company))
+        fingerprint, = Report.get_calculation_fingerprints(
+            [periods], plan, None)
+        code_stats = Report.get_tax_code_stats(plan['prorrata'])
+
+        invoice_stats = (0,)
+        if periods:
+            cursor.execute(*line.join(invoice,
+                    condition=line.invoice == invoice.id
+                    ).join(move,
+                    condition=invoice.move == move.id
+                    ).select(Count(line.id),
+                    Max(line.create_date), Max(line.write_date),
+                    Max(invoice.write_date),
+                    where=(invoice.company == company)
+                    & (invoice.type == 'in')
+                    & reduce_ids(move.period, periods)))
+            invoice_stats = tuple(str(x) for x in cursor.fetchone())
+        cursor.execute(*tax.select(Count(tax.id),
+                Max(tax.create_date), Max(tax.write_date),
+                where=tax.company == company))
+        tax_stats = tuple(str(x) for x in cursor.fetchone())
+
+        key = (fingerprint, code_stats, invoice_stats, tax_stats)
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _get_prorrata_non_deductible_base(cls, company, periods):
+        '''
+        Return the VAT base of the posted supplier invoice lines of the
+        periods with a deductible rate of 0.
+
+        The base of the lines that only have taxes without children nor
+        unit price update is the rounded amount of the line when it has a
+        VAT tax valid at its tax date, so it is aggregated by amount with a
+        single query. The taxes of the other lines are computed to take the
+        base of their first VAT tax.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        LineTax = pool.get('account.invoice.line-account.tax')
+        Move = pool.get('account.move')
+        Tax = pool.get('account.tax')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        invoice = Invoice.__table__()
+        line = InvoiceLine.__table__()
+        move = Move.__table__()
+        line_tax = LineTax.__table__()
+        tax = Tax.__table__()
+        child = Tax.__table__()
+
+        if not periods:
+            return Decimal(0)
+
+        complex_lines = line_tax.join(tax,
+            condition=line_tax.tax == tax.id
+            ).select(line_tax.line,
+            where=(tax.update_unit_price == Literal(True))
+            | tax.id.in_(child.select(child.parent,
+                    where=child.parent != Null)))
+        from_ = line.join(invoice,
+            condition=line.invoice == invoice.id
+            ).join(move,
+            condition=invoice.move == move.id)
+        where = ((invoice.company == company)
+            & invoice.state.in_(['posted', 'paid'])
+            & reduce_ids(move.period, periods)
+            & (invoice.type == 'in')
+            & (line.type == 'line')
+            & (line.taxes_deductible_rate == Decimal(0)))
+
+        tax_date = Coalesce(line.taxes_date, invoice.accounting_date,
+            invoice.invoice_date)
+        vat_taxes = line_tax.join(tax,
+            condition=line_tax.tax == tax.id
+            ).select(Literal(1),
+            where=(line_tax.line == line.id)
+            & (tax.tax_kind == 'vat')
+            & (tax.type != 'none')
+            & ((tax.start_date == Null) | (tax.start_date <= tax_date))
+            & ((tax.end_date == Null) | (tax.end_date >= tax_date)))
+        cursor.execute(*from_.select(
+                line.currency, line.quantity, line.unit_price,
+                Count(Literal('*')),
+                where=where
+                & ~line.id.in_(complex_lines)
+                & Exists(vat_taxes),
+                group_by=[line.currency, line.quantity, line.unit_price]))
+        base = Decimal(0)
+        currencies = {}
+        for currency_id, quantity, unit_price, count in cursor:
+            if currency_id not in currencies:
+                currencies[currency_id] = Currency(currency_id)
+            amount = (Decimal(str(unit_price or 0))
+                * Decimal(str(quantity or 0)))
+            base += currencies[currency_id].round(amount) * count
+
+        cursor.execute(*from_.select(line.id,
+                where=where & line.id.in_(complex_lines)))
+        invoice_lines = InvoiceLine.browse([i for i, in cursor])
+        with Transaction().set_context(_deductible_rate=1):
+            for invoice_line in invoice_lines:
+                for tax_line in invoice_line._get_taxes().values():
+                    tax = Tax(tax_line.tax)
+                    if tax.tax_kind == 'vat':
+                        base += tax_line.base
+                        break
+        return base
+
 
 class ConfigurationAEAT303(ModelSQL, CompanyValueMixin):
     "AEAT 303 Account Configuration"
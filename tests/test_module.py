@@ -1,14 +1,390 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import unicodedata
+from decimal import Decimal
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.filestore import filestore
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction, inactive_records
 
 
 class Aeat303TestCase(CompanyTestMixin, ModuleTestCase):
     'Test Aeat303 module'
     module = 'aeat_303'
 
+    def test_encode_file(self):
+        'Test encode_file is the same as removing accents and upper case'
+        from trytond.modules.aeat_303.aeat import encode_file, remove_accents
+
+        def encode(text):
+            return remove_accents(text).upper().encode(
+                'iso-8859-1', errors='ignore')
+
+        corpus = [
+            'Peña Muñoz, Begoña', 'Ñandú Comunicación S.L.',
+            'Avinguda Diagonal, 640, 3r 2a', 'Plaça de Catalunya',
+            'C/ Sant Joan de Déu, nº 12', 'Façana Ütrecht Ærø Øster',
+            'Straße Groß ŉ ǰ ﬁ', 'Ελλάδα Αθήνα', 'Москва',
+            'ñ ç ẹ́ ̣́a',
+            'ḉ́ Ǖ ệ ﬃ', '東京 서울 ﷺ',
+            ]
+        chars = ''.join(chr(i) for i in range(0x10000)
+            if unicodedata.category(chr(i)) != 'Cs')
+        for text in corpus + [chars, ' '.join(corpus) * 1000]:
+            self.assertEqual(encode_file(text), encode(text))
+
+    @with_transaction()
+    def test_search_order_totals(self):
+        'Test search and order the reports by their totals'
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Report = pool.get('aeat.303.report')
+
+        eur, = Currency.create([{
+                    'name': 'Euro',
+                    'symbol': '€',
+                    'code': 'EUR',
+                    }])
+        company = create_company(currency=eur)
+        with set_company(company):
+            report1, report2, report3, report4 = Report.create([{
+                        'company': company.id,
+                        'year': 2024,
+                        'period': period,
+                        'type': 'I',
+                        'accrued_vat_tax_1': tax1,
+                        'accrued_vat_tax_3': tax3,
+                        'deductible_current_domestic_operations_tax': (
+                            deductible),
+                        } for period, tax1, tax3, deductible in [
+                        ('01', None, Decimal('50.40'), None),
+                        ('02', None, Decimal('10.10'), None),
+                        ('03', None, Decimal('10.10'), Decimal('30.20')),
+                        ('04', Decimal('0.10'), Decimal('0.20'), None),
+                        ]])
+            reports = [report1, report2, report3, report4]
+            self.assertEqual([r.liquidation_result for r in reports], [
+                    Decimal('50.40'), Decimal('10.10'), Decimal('-20.10'),
+                    Decimal('0.30')])
+
+            for domain, result in [
+                    ([('liquidation_result', '>', Decimal('10.10'))],
+                        [report1]),
+                    ([('liquidation_result', '>=', Decimal('10.10'))],
+                        [report1, report2]),
+                    ([('liquidation_result', '=', Decimal('50.40'))],
+                        [report1]),
+                    ([('liquidation_result', '=', Decimal('0.30'))],
+                        [report4]),
+                    ([('liquidation_result', '<', 0)], [report3]),
+                    ([('liquidation_result', 'in',
+                                [Decimal('50.40'), Decimal('0.30')])],
+                        [report1, report4]),
+                    ([('liquidation_result', 'not in',
+                                [Decimal('50.40'), Decimal('0.30')])],
+                        [report2, report3]),
+                    ([('result', '=', Decimal('10.10'))], [report2]),
+                    ([('result', '=', None)], []),
+                    ([('result', '!=', None)], reports),
+                    ([('result', '>', None)], []),
+                    ([('result', 'in', [None])], []),
+                    ([('result', 'not in', [None])], reports),
+                    ([('liquidation_result', 'in',
+                                [Decimal('50.40'), None])],
+                        [report1]),
+                    ([('liquidation_result', 'not in',
+                                [Decimal('50.40'), None])],
+                        [report2, report3, report4]),
+                    ]:
+                with self.subTest(domain=domain):
+                    self.assertEqual(
+                        Report.search(domain, order=[('id', 'ASC')]),
+                        result)
+
+            for order, result in [
+                    ([('liquidation_result', 'ASC')],
+                        [report3, report4, report2, report1]),
+                    ([('liquidation_result', 'DESC')],
+                        [report1, report2, report4, report3]),
+                    ([('result', 'ASC')],
+                        [report3, report4, report2, report1]),
+                    ]:
+                with self.subTest(order=order):
+                    self.assertEqual(Report.search([], order=order), result)
+
+    @with_transaction()
+    def test_totals_state_administration_amount(self):
+        'Test the state administration amount is rounded to the currency'
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Report = pool.get('aeat.303.report')
+
+        eur, = Currency.create([{
+                    'name': 'Euro',
+                    'symbol': '€',
+                    'code': 'EUR',
+                    }])
+        company = create_company(currency=eur)
+        with set_company(company):
+            reports = Report.create([{
+                        'company': company.id,
+                        'year': 2024,
+                        'period': period,
+                        'type': 'I',
+                        'accrued_vat_tax_3': Decimal('50.40'),
+                        'state_administration_percent': percent,
+                        } for period, percent in [
+                        ('01', Decimal('100.00')),
+                        ('02', Decimal('33.33')),
+                        ]])
+
+            for name in ['state_administration_amount', 'result',
+                    'liquidation_result']:
+                with self.subTest(name=name):
+                    self.assertEqual(
+                        [str(getattr(r, name)) for r in reports],
+                        ['50.40', '16.80'])
+
+    @with_transaction()
+    def test_file_filestore(self):
+        'Test the files are stored compressed once their year is archived'
+        from trytond.modules.aeat_303.aeat import _GZIP_MAGIC
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        FiscalYear = pool.get('account.fiscalyear')
+        Report = pool.get('aeat.303.report')
+        transaction = Transaction()
+        prefix = transaction.database.name
+
+        eur, = Currency.create([{
+                    'name': 'Euro',
+                    'symbol': '€',
+                    'code': 'EUR',
+                    }])
+        company = create_company(currency=eur)
+        with set_company(company):
+            fiscalyear = get_fiscalyear(
+                company, today=datetime.date(2024, 1, 1))
+            fiscalyear.save()
+            report, = Report.create([{
+                        'company': company.id,
+                        'year': 2024,
+                        'period': '01',
+                        'type': 'I',
+                        'file_': b'303 file',
+                        }])
+            self.assertTrue(report.file_id)
+            self.assertEqual(
+                filestore.get(report.file_id, prefix=prefix), b'303 file')
+            self.assertEqual(report.file_, b'303 file')
+
+            # Close the fiscal year compresses the files of its reports
+            FiscalYear.close([fiscalyear])
+            report = Report(report.id)
+            self.assertEqual(
+                filestore.get(report.file_id, prefix=prefix)[:2],
+                _GZIP_MAGIC)
+            self.assertEqual(report.file_, b'303 file')
+
+            # The new files of archived years are stored compressed
+            Report.write([report], {'file_': b'303 new file'})
+            report = Report(report.id)
+            self.assertEqual(
+                filestore.get(report.file_id, prefix=prefix)[:2],
+                _GZIP_MAGIC)
+            self.assertEqual(report.file_, b'303 new file')
+
+            # Migration from 8.0: the files are moved to the filestore and
+            # compressed only for the archived years
+            TableHandler = backend.TableHandler
+            table = Report.__table__()
+            cursor = transaction.connection.cursor()
+            TableHandler(Report).add_column('file_', 'BLOB')
+            ids = []
+            for year in [2024, 2025]:
+                cursor.execute(*table.insert(
+                        [table.company, table.year, table.period, table.type,
+                            table.state, table.file_],
+                        [[company.id, year, '02', 'I', 'done',
+                                b'303 old file']]))
+                ids.append(transaction.database.lastid(cursor))
+            Report.__register__('aeat_303')
+            self.assertFalse(TableHandler(Report).column_exist('file_'))
+            old_report1, old_report2 = Report.browse(ids)
+            self.assertEqual(
+                filestore.get(old_report1.file_id, prefix=prefix)[:2],
+                _GZIP_MAGIC)
+            self.assertEqual(
+                filestore.get(old_report2.file_id, prefix=prefix),
+                b'303 old file')
+            self.assertEqual(old_report1.file_, b'303 old file')
+            self.assertEqual(old_report2.file_, b'303 old file')
+
+    @with_transaction()
+    def test_mapping_plan_cache(self):
+        'Test the mapping plan is cached until a tax code is modified'
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        Field = pool.get('ir.model.field')
+        Mapping = pool.get('aeat.303.mapping')
+
+        company1 = create_company()
+        company2 = create_company(name='Company 2')
+        with set_company(company1):
+            code, = TaxCode.create([{
+                        'name': 'Tax Code',
+                        'company': company1.id,
+                        }])
+            field, = Field.search([
+                    ('model', '=', 'aeat.303.report'),
+                    ('name', '=', 'accrued_vat_tax_3'),
+                    ])
+            Mapping.create([{
+                        'company': company1.id,
+                        'aeat303_field': field.id,
+                        'type_': 'code',
+                        'code': [('add', [code.id])],
+                        }])
+
+            plan = Mapping.get_mapping_plan(company1)
+            self.assertEqual(dict(plan['code']), {
+                    code.id: ('accrued_vat_tax_3',)})
+            with self.assertRaises(TypeError):
+                plan['code'][code.id] = ()
+            self.assertEqual(Mapping.get_mapping_plan(company1), plan)
+
+            # The code of another company is no more in the plan
+            TaxCode.write([code], {'company': company2.id})
+            self.assertEqual(
+                dict(Mapping.get_mapping_plan(company1)['code']), {})
+
+    @with_transaction()
+    def test_update_mappings(self):
+        'Test update the mappings of a company from the templates'
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        TaxCodeTemplate = pool.get('account.tax.code.template')
+        MappingTemplate = pool.get('aeat.303.template.mapping')
+        Mapping = pool.get('aeat.303.mapping')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company, tax=True)
+            code_template, = TaxCodeTemplate.search([
+                    ('name', '=', 'Tax Code'),
+                    ])
+            code, = TaxCode.search([('template', '=', code_template.id)])
+            template, = MappingTemplate.search([
+                    ('aeat303_field.model', '=', 'aeat.303.report'),
+                    ('aeat303_field.name', '=', 'accrued_vat_tax_3'),
+                    ])
+            MappingTemplate.write([template], {
+                    'code': [('add', [code_template.id])],
+                    })
+
+            Mapping.update_companies([company])
+            mapping, = Mapping.search([('template', '=', template.id)])
+            self.assertEqual(mapping.company, company)
+            self.assertEqual(list(mapping.code), [code])
+
+            # The inactive tax codes are not added to the mappings
+            with inactive_records():
+                TaxCode.create([{
+                            'name': 'Inactive Tax Code',
+                            'company': company.id,
+                            'template': code_template.id,
+                            'end_date': datetime.date(2000, 1, 1),
+                            }])
+            Mapping.update_companies([company])
+            mapping, = Mapping.search([('template', '=', template.id)])
+            self.assertEqual(list(mapping.code), [code])
+
+            # The tax codes that become inactive are removed from the mappings
+            new_code, = TaxCode.create([{
+                        'name': 'New Tax Code',
+                        'company': company.id,
+                        'template': code_template.id,
+                        }])
+            with inactive_records():
+                TaxCode.write([code], {'end_date': datetime.date(2000, 1, 1)})
+            Mapping.update_companies([company])
+            mapping, = Mapping.search([('template', '=', template.id)])
+            self.assertEqual(list(mapping.code), [new_code])
+
+    @with_transaction()
+    def test_update_mappings_companies(self):
+        'Test update the mappings of many companies with the wizard'
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        TaxCodeTemplate = pool.get('account.tax.code.template')
+        MappingTemplate = pool.get('aeat.303.template.mapping')
+        Mapping = pool.get('aeat.303.mapping')
+        UpdateMappings = pool.get('aeat.303.mapping.update', type='wizard')
+
+        company1 = create_company()
+        company2 = create_company(name='Company 2')
+        with set_company(company1):
+            create_chart(company1, tax=True)
+            code_template, = TaxCodeTemplate.search([
+                    ('name', '=', 'Tax Code'),
+                    ])
+            with set_company(company2):
+                create_chart(company2)
+                code1, = TaxCode.search([
+                        ('template', '=', code_template.id),
+                        ('company', '=', company1.id),
+                        ])
+                code2, = TaxCode.search([
+                        ('template', '=', code_template.id),
+                        ('company', '=', company2.id),
+                        ])
+                template, shared_template = MappingTemplate.search([
+                        ('aeat303_field.model', '=', 'aeat.303.report'),
+                        ('aeat303_field.name', 'in', [
+                                'accrued_vat_tax_3', 'accrued_vat_tax_1']),
+                        ], order=[('aeat303_field.name', 'DESC')])
+                MappingTemplate.write([template, shared_template], {
+                        'code': [('add', [code_template.id])],
+                        })
+                shared, = Mapping.create([{
+                            'company': None,
+                            'aeat303_field': shared_template.aeat303_field.id,
+                            'type_': 'code',
+                            'template': shared_template.id,
+                            'code': [('add', [code1.id])],
+                            }])
+
+                session_id, _, _ = UpdateMappings.create()
+                UpdateMappings.execute(session_id, {
+                        'start': {
+                            'companies': [company1.id, company2.id],
+                            },
+                        }, 'update')
+                UpdateMappings.delete(session_id)
+
+                mapping1, mapping2 = Mapping.search([
+                        ('template', '=', template.id),
+                        ], order=[('company', 'ASC')])
+                self.assertEqual(
+                    (mapping1.company, list(mapping1.code)),
+                    (company1, [code1]))
+                self.assertEqual(
+                    (mapping2.company, list(mapping2.code)),
+                    (company2, [code2]))
+
+                # The mapping without company keeps the codes of all the
+                # companies
+                self.assertEqual(
+                    Mapping.search([('template', '=', shared_template.id)]),
+                    [shared])
+                self.assertEqual(
+                    sorted(shared.code), sorted([code1, code2]))
+
 
 del ModuleTestCase
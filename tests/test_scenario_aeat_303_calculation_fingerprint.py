@@ -0,0 +1,122 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        _ = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create tax with its codes
+        tax = create_tax(Decimal('.21'))
+        tax.save()
+        base_code, base_child = create_tax_code_tree(tax, 'base')
+        tax_code, tax_child = create_tax_code_tree(tax, 'tax')
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [tax_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post an out invoice
+        Invoice = Model.get('account.invoice')
+        invoice = Invoice(type='out')
+        invoice.party = party
+        invoice.invoice_date = period.start_date
+        line = invoice.lines.new()
+        line.account = accounts['revenue']
+        line.description = 'Test'
+        line.quantity = 2
+        line.unit_price = Decimal('100.00')
+        line.taxes.append(tax)
+        invoice.click('post')
+
+        # Calculate the report
+        Report = Model.get('aeat.303.report')
+        report = Report()
+        report.year = period.start_date.year
+        report.period = '%02d' % period.start_date.month
+        report.type = 'I'
+        report.return_sepa_check = '0'
+        report.exonerated_mod390 = '0' if report.period != '12' else '2'
+        report.company_vat = '123456789'
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('200.00'))
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('42.00'))
+        calculation_date = report.calculation_date
+
+        # Calculate again without changes skips the report
+        report.click('draft')
+        report.accrued_vat_base_3 = Decimal('999.00')
+        report.save()
+        report.click('calculate')
+        self.assertEqual(report.state, 'calculated')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('999.00'))
+        self.assertEqual(report.calculation_date, calculation_date)
+
+        # Modify the code line of a child code calculates the report
+        code_line, = base_child.lines
+        code_line.operator = '-'
+        base_child.save()
+        report.click('draft')
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('-200.00'))
+
+        # Add a code line to a child code calculates the report
+        code_line = tax_child.lines.new()
+        code_line.tax = tax
+        code_line.amount = 'base'
+        code_line.type = 'invoice'
+        tax_child.save()
+        report.click('draft')
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('242.00'))
+
+        # Move a child code out of the tree calculates the report
+        tax_child.parent = None
+        tax_child.save()
+        report.click('draft')
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('0.00'))
@@ -0,0 +1,128 @@
+import io
+import unittest
+import zipfile
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model, Wizard
+from trytond.exceptions import UserError
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303 import aeat
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        _ = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create tax with its codes
+        tax = create_tax(Decimal('.21'))
+        tax.save()
+        base_code, base_child = create_tax_code_tree(tax, 'base')
+        tax_code, tax_child = create_tax_code_tree(tax, 'tax')
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [tax_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post an out invoice
+        Invoice = Model.get('account.invoice')
+        invoice = Invoice(type='out')
+        invoice.party = party
+        invoice.invoice_date = period.start_date
+        line = invoice.lines.new()
+        line.account = accounts['revenue']
+        line.description = 'Test'
+        line.quantity = 2
+        line.unit_price = Decimal('120.00')
+        line.taxes.append(tax)
+        invoice.click('post')
+
+        # Process the report
+        Report = Model.get('aeat.303.report')
+        report = Report()
+        report.year = period.start_date.year
+        report.period = '%02d' % period.start_date.month
+        report.type = 'I'
+        report.return_sepa_check = '0'
+        report.exonerated_mod390 = '0' if report.period != '12' else '2'
+        report.company_vat = '123456789'
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('50.40'))
+        self.assertEqual(report.liquidation_result, Decimal('50.40'))
+        report.click('process')
+        self.assertEqual(report.state, 'done')
+        self.assertTrue(report.file_id)
+        data = bytes(report.file_)
+
+        # Import the file of the report
+        import_ = Wizard('aeat.303.report.import')
+        import_.form.company = company
+        import_.form.file_ = data
+        import_.form.filename = 'aeat303.txt'
+        import_.execute('import_')
+        imported, = Report.find([('id', '!=', report.id)])
+        self.assertEqual(imported.state, 'done')
+        self.assertEqual(imported.company, company)
+        self.assertEqual(imported.year, report.year)
+        self.assertEqual(imported.period, report.period)
+        self.assertEqual(imported.accrued_vat_base_3, Decimal('240.00'))
+        self.assertEqual(imported.accrued_vat_tax_3, Decimal('50.40'))
+        self.assertEqual(
+            imported.state_administration_percent, Decimal('100.00'))
+        self.assertEqual(imported.liquidation_result, Decimal('50.40'))
+        self.assertEqual(bytes(imported.file_), data)
+
+        # The number of reports exported at once is limited
+        with patch.object(aeat, 'EXPORT_LIMIT', 1):
+            with self.assertRaises(UserError):
+                Wizard('aeat.303.report.export', [report, imported])
+
+        # Export the files regenerated from the reports
+        export = Wizard('aeat.303.report.export', [report, imported])
+        with zipfile.ZipFile(io.BytesIO(export.form.file_)) as archive:
+            names = archive.namelist()
+            self.assertEqual(len(names), 2)
+            for name in names:
+                self.assertEqual(archive.read(name), data)
+        self.assertEqual(export.form.filename, 'aeat303.zip')
@@ -0,0 +1,214 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, create_tax_code,
+    get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        Account = Model.get('account.account')
+        other_tax_account, = Account.find([
+                ('company', '=', company.id),
+                ('code', '=', '6.3.4'),
+                ])
+        move_account, = Account.find([
+                ('company', '=', company.id),
+                ('code', '=', '2.4.3'),
+                ])
+        Journal = Model.get('account.journal')
+        journal, = Journal.find([('type', '=', 'general')], limit=1)
+
+        # Create the sale and purchase taxes
+        tax21 = create_tax(Decimal('.21'))
+        tax21.save()
+        tax10 = create_tax(Decimal('.10'))
+        tax10.invoice_account = other_tax_account
+        tax10.credit_note_account = other_tax_account
+        tax10.save()
+        purchase_tax = create_tax(Decimal('.21'))
+        purchase_tax.save()
+
+        # Create a tree of accrued codes with nested children
+        TaxCode = Model.get('account.tax.code')
+        accrued_code = TaxCode(name="Accrued")
+        accrued_code.save()
+        code21 = create_tax_code(tax21, amount='tax', type='invoice')
+        code21.name = "Accrued 21"
+        code_line = code21.lines.new()
+        code_line.tax = tax21
+        code_line.amount = 'tax'
+        code_line.type = 'credit'
+        code_line.operator = '-'
+        code21.parent = accrued_code
+        code21.save()
+        sub_code = TaxCode(name="Accrued Sub")
+        sub_code.parent = accrued_code
+        sub_code.save()
+        code10 = create_tax_code(tax10, amount='tax', type='invoice')
+        code10.name = "Accrued 10"
+        code10.parent = sub_code
+        code10.save()
+        empty_code = create_tax_code(tax10, amount='tax', type='credit')
+        empty_code.name = "Accrued 10 Credit"
+        empty_code.parent = sub_code
+        empty_code.save()
+        base_code, base_child = create_tax_code_tree(tax21, 'base')
+
+        # Create a deductible code without children
+        deductible_code = create_tax_code(
+            purchase_tax, amount='tax', type='invoice')
+        deductible_code.name = "Deductible"
+        deductible_code.save()
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [accrued_code])
+        _ = create_mapping(
+            company, 'deductible_current_domestic_operations_tax',
+            [deductible_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post invoices and credit notes
+        Invoice = Model.get('account.invoice')
+
+        def post_invoice(type, account, lines):
+            invoice = Invoice(type=type)
+            invoice.party = party
+            invoice.invoice_date = period.start_date
+            for quantity, unit_price, tax in lines:
+                line = invoice.lines.new()
+                line.account = account
+                line.description = 'Line'
+                line.quantity = quantity
+                line.unit_price = unit_price
+                line.taxes.append(Model.get('account.tax')(tax.id))
+            invoice.click('post')
+            return invoice
+
+        _ = post_invoice('out', accounts['revenue'], [
+                (2, Decimal('100.00'), tax21),
+                (1, Decimal('100.00'), tax10),
+                ])
+        _ = post_invoice('out', accounts['revenue'], [
+                (-1, Decimal('50.00'), tax21),
+                ])
+        _ = post_invoice('in', accounts['expense'], [
+                (1, Decimal('100.00'), purchase_tax),
+                ])
+
+        # Process the report creates the move with the counterpart of the
+        # tax lines of the last level codes by account
+        Report = Model.get('aeat.303.report')
+        report = Report()
+        report.year = period.start_date.year
+        report.period = '%02d' % period.start_date.month
+        report.type = 'I'
+        report.return_sepa_check = '0'
+        report.exonerated_mod390 = '0' if report.period != '12' else '2'
+        report.company_vat = '123456789'
+        report.move_account = move_account
+        report.move_journal = journal
+        report.move_description = 'AEAT 303 Move'
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('200.00'))
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('41.50'))
+        self.assertEqual(
+            report.deductible_current_domestic_operations_tax,
+            Decimal('21.00'))
+        self.assertEqual(report.liquidation_result, Decimal('20.50'))
+
+        # The debit and credit of the tax lines are aggregated by last level
+        # code and account
+        with Transaction().start(config.database_name, config.user,
+                context=config.context, readonly=True):
+            ReportModel = Pool().get('aeat.303.report')
+            report_record = ReportModel(report.id)
+            codes = [base_code.id, accrued_code.id, deductible_code.id]
+            periods = report_record.get_periods()
+            self.assertEqual(
+                report_record.get_move_codes(codes, periods),
+                [base_child.id, code21.id, code10.id, deductible_code.id])
+            self.assertEqual(
+                report_record.get_move_line_amounts(codes, periods), {
+                    (code21.id, accounts['tax'].id): (
+                        Decimal('10.50'), Decimal('42.00')),
+                    (code10.id, other_tax_account.id): (
+                        Decimal('0.00'), Decimal('10.00')),
+                    (deductible_code.id, accounts['tax'].id): (
+                        Decimal('21.00'), Decimal('0.00')),
+                    })
+
+        report.click('process')
+        self.assertEqual(report.state, 'done')
+
+        move = report.move
+        self.assertEqual(move.state, 'draft')
+        self.assertEqual(move.journal, journal)
+        self.assertEqual(move.period, period)
+        self.assertEqual(move.date, period.end_date)
+        self.assertEqual(move.origin, report)
+        self.assertEqual(move.description, 'AEAT 303 Move')
+        self.assertEqual(sorted(
+                (l.description, l.account.code, l.debit, l.credit)
+                for l in move.lines), sorted([
+                    ("Accrued 21", accounts['tax'].code,
+                        Decimal('31.50'), Decimal('0.00')),
+                    ("Accrued 10", other_tax_account.code,
+                        Decimal('10.00'), Decimal('0.00')),
+                    ("Deductible", accounts['tax'].code,
+                        Decimal('0.00'), Decimal('21.00')),
+                    ('AEAT 303 Move', move_account.code,
+                        Decimal('0.00'), Decimal('20.50')),
+                    ]))
+
+        # There is no move without account for the counterpart
+        with Transaction().start(config.database_name, config.user,
+                context=config.context, readonly=True):
+            report_record = Pool().get('aeat.303.report')(report.id)
+            report_record.move_account = None
+            self.assertEqual(report_record.get_move_values(), None)
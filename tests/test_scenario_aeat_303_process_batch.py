@@ -0,0 +1,139 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period1, period2 = fiscalyear.periods[:2]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        Account = Model.get('account.account')
+        move_account, = Account.find([
+                ('company', '=', company.id),
+                ('code', '=', '2.4.3'),
+                ])
+        Journal = Model.get('account.journal')
+        journal, = Journal.find([('type', '=', 'general')], limit=1)
+
+        # Create tax with its codes
+        tax = create_tax(Decimal('.21'))
+        tax.save()
+        base_code, base_child = create_tax_code_tree(tax, 'base')
+        tax_code, tax_child = create_tax_code_tree(tax, 'tax')
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [tax_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post an out invoice in each period
+        Invoice = Model.get('account.invoice')
+        for period, unit_price in [
+                (period1, Decimal('100.00')),
+                (period2, Decimal('200.00'))]:
+            invoice = Invoice(type='out')
+            invoice.party = party
+            invoice.invoice_date = period.start_date
+            line = invoice.lines.new()
+            line.account = accounts['revenue']
+            line.description = 'Test'
+            line.quantity = 1
+            line.unit_price = unit_price
+            line.taxes.append(Model.get('account.tax')(tax.id))
+            invoice.click('post')
+
+        # Calculate the reports of both periods to post and close them
+        Report = Model.get('aeat.303.report')
+        reports = []
+        for period in [period1, period2]:
+            report = Report()
+            report.year = period.start_date.year
+            report.period = '%02d' % period.start_date.month
+            report.type = 'I'
+            report.return_sepa_check = '0'
+            report.exonerated_mod390 = '0'
+            report.company_vat = '123456789'
+            report.post_and_close = True
+            report.move_account = move_account
+            report.move_journal = journal
+            report.save()
+            reports.append(report)
+        Report.click(reports, 'calculate')
+        self.assertEqual(
+            [r.accrued_vat_tax_3 for r in reports],
+            [Decimal('21.00'), Decimal('42.00')])
+
+        # Process both reports at once posts their moves, closes their
+        # periods and stores the amounts of the codes
+        Report.click(reports, 'process')
+        self.assertEqual([r.state for r in reports], ['done', 'done'])
+        report1, report2 = reports
+        self.assertNotEqual(report1.move, report2.move)
+        self.assertEqual(
+            [(r.move.state, r.move.period) for r in reports],
+            [('posted', period1), ('posted', period2)])
+        self.assertEqual(
+            [sum(l.credit for l in r.move.lines
+                    if l.account == move_account) for r in reports],
+            [Decimal('21.00'), Decimal('42.00')])
+        period1.reload()
+        period2.reload()
+        self.assertEqual(
+            [period1.state, period2.state], ['closed', 'closed'])
+
+        with Transaction().start(config.database_name, config.user,
+                readonly=True):
+            Balance = Pool().get('aeat.303.tax.code.balance')
+            balances = {(b.period.id, b.code.id): b.amount
+                for b in Balance.search([])}
+        self.assertEqual(
+            {k: v for k, v in balances.items()
+                if k[1] in {base_child.id, tax_child.id}}, {
+                (period1.id, base_child.id): Decimal('100.00'),
+                (period1.id, tax_child.id): Decimal('21.00'),
+                (period2.id, base_child.id): Decimal('200.00'),
+                (period2.id, tax_child.id): Decimal('42.00'),
+                })
@@ -0,0 +1,166 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(
+            ['aeat_303', 'account_es', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        usd = get_currency('USD')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create the VAT and the other taxes
+        Tax = Model.get('account.tax')
+        other_kind = next(kind
+            for kind, _ in Tax._fields['tax_kind']['selection']
+            if kind and kind != 'vat')
+
+        def create_kind_tax(rate, kind, sequence=None):
+            tax = create_tax(rate)
+            tax.tax_kind = kind
+            tax.sequence = sequence
+            return tax
+
+        vat_tax = create_kind_tax(Decimal('.21'), 'vat', 2)
+        vat_tax.save()
+        other_tax = create_kind_tax(Decimal('-.15'), other_kind, 1)
+        other_tax.save()
+        price_tax = create_kind_tax(Decimal('.05'), other_kind, 1)
+        price_tax.update_unit_price = True
+        price_tax.save()
+        expired_tax = create_kind_tax(Decimal('.10'), 'vat')
+        expired_tax.end_date = period.start_date - datetime.timedelta(days=1)
+        expired_tax.save()
+        none_tax = create_kind_tax(Decimal('.04'), 'vat')
+        none_tax.type = 'none'
+        none_tax.save()
+        parent_tax = Tax(name='Parent Tax', description='Parent Tax')
+        parent_tax.type = 'none'
+        parent_tax.tax_kind = other_kind
+        parent_tax.save()
+        for rate, kind, sequence in [
+                (Decimal('-.01'), other_kind, 1),
+                (Decimal('.21'), 'vat', 2)]:
+            child_tax = create_kind_tax(rate, kind, sequence)
+            child_tax.parent = parent_tax
+            child_tax.save()
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post supplier invoices and credit notes with non deductible lines
+        Invoice = Model.get('account.invoice')
+
+        def post_invoice(currency, lines):
+            invoice = Invoice(type='in')
+            invoice.party = party
+            invoice.currency = currency
+            invoice.invoice_date = period.start_date
+            for quantity, unit_price, taxes, rate, taxes_date in lines:
+                line = invoice.lines.new()
+                line.account = accounts['expense']
+                line.description = 'Line'
+                line.quantity = quantity
+                line.unit_price = unit_price
+                for tax in taxes:
+                    line.taxes.append(Tax(tax.id))
+                line.taxes_deductible_rate = Decimal(rate)
+                line.taxes_date = taxes_date
+            invoice.click('post')
+            return invoice
+
+        expired_date = expired_tax.end_date
+        _ = post_invoice(eur, [
+                (3, Decimal('0.3350'), [vat_tax], 0, None),
+                (2, Decimal('100'), [other_tax, vat_tax], 0, None),
+                (1, Decimal('50'), [other_tax], 0, None),
+                (1, Decimal('80'), [price_tax, vat_tax], 0, None),
+                (2, Decimal('30'), [parent_tax], 0, None),
+                (1, Decimal('40'), [expired_tax], 0, None),
+                (1, Decimal('45'), [expired_tax], 0, expired_date),
+                (1, Decimal('60'), [none_tax], 0, None),
+                (1, Decimal('70'), [vat_tax], 1, None),
+                ])
+        _ = post_invoice(usd, [
+                (1, Decimal('10.0050'), [vat_tax], 0, None),
+                (4, Decimal('2.5'), [other_tax, vat_tax], 0, None),
+                (3, Decimal('20'), [price_tax, vat_tax], 0, None),
+                ])
+        _ = post_invoice(eur, [
+                (-1, Decimal('100'), [vat_tax], 0, None),
+                (-3, Decimal('0.3350'), [other_tax, vat_tax], 0, None),
+                (-2, Decimal('80'), [price_tax, vat_tax], 0, None),
+                (-1, Decimal('30'), [parent_tax], 0, None),
+                ])
+
+        # The query gives the base of the first VAT tax of the computed
+        # taxes of each line
+        with Transaction().start(config.database_name, config.user,
+                context=config.context, readonly=True):
+            pool = Pool()
+            Configuration = pool.get('account.configuration')
+            InvoiceLine = pool.get('account.invoice.line')
+            TaxModel = pool.get('account.tax')
+
+            periods = [p.id for p in fiscalyear.periods]
+            lines = InvoiceLine.search([
+                    ('invoice.company', '=', company.id),
+                    ('invoice.state', 'in', ['posted', 'paid']),
+                    ('invoice.move.period', 'in', periods),
+                    ('invoice.type', '=', 'in'),
+                    ('type', '=', 'line'),
+                    ('taxes_deductible_rate', '=', 0),
+                    ])
+            self.assertEqual(len(lines), 15)
+            expected = Decimal(0)
+            with Transaction().set_context(_deductible_rate=1):
+                for line in lines:
+                    for tax_line in line._get_taxes().values():
+                        if TaxModel(tax_line.tax).tax_kind == 'vat':
+                            expected += tax_line.base
+                            break
+            self.assertEqual(expected, Decimal('174.00'))
+            self.assertEqual(
+                Configuration._get_prorrata_non_deductible_base(
+                    company.id, periods),
+                expected)
@@ -0,0 +1,111 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303.tests.tools import (
+    create_prorrata_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create the deductible and the exempt taxes with their codes
+        deductible_tax = create_tax(Decimal('.21'))
+        deductible_tax.save()
+        exempt_tax = create_tax(Decimal('0'))
+        exempt_tax.save()
+        deductible_code, _ = create_tax_code_tree(
+            deductible_tax, 'base')
+        exempt_code, exempt_child = create_tax_code_tree(exempt_tax, 'base')
+
+        # Create the prorrata mappings
+        _ = create_prorrata_mapping(
+            company, 'prorrata_deductible_amount', [deductible_code])
+        _ = create_prorrata_mapping(
+            company, 'prorrata_total_amount', [exempt_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post an in invoice
+        Invoice = Model.get('account.invoice')
+        invoice = Invoice(type='in')
+        invoice.party = party
+        invoice.invoice_date = period.start_date
+        line = invoice.lines.new()
+        line.account = accounts['expense']
+        line.description = 'Deductible'
+        line.quantity = 1
+        line.unit_price = Decimal('100.00')
+        line.taxes.append(deductible_tax)
+        line = invoice.lines.new()
+        line.account = accounts['expense']
+        line.description = 'Exempt'
+        line.quantity = 1
+        line.unit_price = Decimal('300.00')
+        line.taxes.append(exempt_tax)
+        invoice.click('post')
+
+        # The prorrata is cached by its fingerprint
+        def get_fingerprint():
+            with Transaction().start(config.database_name, config.user,
+                    context=config.context, readonly=True):
+                Configuration = Pool().get('account.configuration')
+                return Configuration._get_prorrata_fingerprint(
+                    company.id, [p.id for p in fiscalyear.periods])
+
+        fingerprint = get_fingerprint()
+        self.assertEqual(get_fingerprint(), fingerprint)
+
+        # Add a code line to a child code of the prorrata changes it
+        code_line = exempt_child.lines.new()
+        code_line.tax = deductible_tax
+        code_line.amount = 'base'
+        code_line.type = 'invoice'
+        exempt_child.save()
+        self.assertNotEqual(get_fingerprint(), fingerprint)
+        fingerprint = get_fingerprint()
+
+        # Move the child code out of the tree changes it
+        exempt_child.parent = None
+        exempt_child.save()
+        self.assertNotEqual(get_fingerprint(), fingerprint)
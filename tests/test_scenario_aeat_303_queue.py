@@ -0,0 +1,148 @@
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303 import aeat
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    @patch.object(aeat, 'QUEUE_TASKS', True)
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+
+        # Create tax with its codes
+        tax = create_tax(Decimal('.21'))
+        tax.save()
+        base_code, _ = create_tax_code_tree(tax, 'base')
+        tax_code, _ = create_tax_code_tree(tax, 'tax')
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [tax_code])
+
+        # Calculate the reports in a queue task
+        Report = Model.get('aeat.303.report')
+        reports = []
+        for month in ['01', '02', '03', '04', '05']:
+            report = Report()
+            report.year = period.start_date.year
+            report.period = month
+            report.type = 'I'
+            report.return_sepa_check = '0'
+            report.exonerated_mod390 = '0'
+            report.company_vat = '123456789'
+            report.save()
+            reports.append(report)
+        reports, sync_reports = reports[:3], reports[3:]
+        Report.click(reports, 'calculate')
+        self.assertEqual(
+            [r.state for r in reports],
+            ['calculated', 'calculated', 'calculated'])
+        self.assertEqual([r.error for r in reports], [None, None, None])
+        self.assertTrue(all(r.duration is not None for r in reports))
+
+        # Process the reports in a queue task with a user error and an
+        # unexpected error
+        ReportModel = Pool(config.database_name).get('aeat.303.report')
+        create_file = ReportModel.create_file
+
+        def create_file_with_errors(self):
+            if self.period == '02':
+                raise UserError('Invalid file')
+            elif self.period == '03':
+                raise ValueError('Unexpected error')
+            return create_file(self)
+
+        with patch.object(
+                ReportModel, 'create_file', create_file_with_errors):
+            Report.click(reports, 'process')
+        self.assertEqual(
+            [r.state for r in reports], ['done', 'calculated', 'calculated'])
+        report1, report2, report3 = reports
+        self.assertEqual(report1.error, None)
+        self.assertTrue(report1.file_)
+        self.assertEqual(report2.error, 'Invalid file')
+        self.assertEqual(report3.error, 'ValueError: Unexpected error')
+        self.assertEqual(report3.move, None)
+
+        # The reports with a transient database error stay in the queue to
+        # be run again
+        failures = []
+
+        def create_file_with_transient_error(self):
+            if self.period == '03' and len(failures) < 2:
+                failures.append(self.id)
+                raise backend.DatabaseOperationalError
+            return create_file(self)
+
+        with patch.object(
+                ReportModel, 'create_file', create_file_with_transient_error):
+            Report.click([report2, report3], 'process')
+        self.assertEqual(failures, [report3.id, report3.id])
+        self.assertEqual([r.state for r in reports], ['done', 'done', 'done'])
+        self.assertEqual([r.error for r in reports], [None, None, None])
+
+        # Without queue, the reports are run by committed chunks too and the
+        # error is raised after running all of them
+        with patch.object(aeat, 'QUEUE_TASKS', False):
+            Report.click(sync_reports, 'calculate')
+            self.assertEqual(
+                [r.state for r in sync_reports], ['calculated', 'calculated'])
+            report4, report5 = sync_reports
+
+            def create_file_with_user_error(self):
+                if self.id == report5.id:
+                    raise UserError('Invalid file')
+                return create_file(self)
+
+            with patch.object(
+                    ReportModel, 'create_file', create_file_with_user_error):
+                with self.assertRaises(UserError):
+                    Report.click(sync_reports, 'process')
+        for report in sync_reports:
+            report.reload()
+        self.assertEqual(
+            [r.state for r in sync_reports], ['done', 'calculated'])
+        self.assertEqual(
+            [r.error for r in sync_reports], [None, 'Invalid file'])
+        self.assertTrue(report4.file_)
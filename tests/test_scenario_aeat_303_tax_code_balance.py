@@ -0,0 +1,155 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create tax with its codes
+        tax = create_tax(Decimal('.21'))
+        tax.save()
+        base_code, base_child = create_tax_code_tree(tax, 'base')
+        tax_code, tax_child = create_tax_code_tree(tax, 'tax')
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [tax_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post an out invoice
+        Invoice = Model.get('account.invoice')
+        invoice = Invoice(type='out')
+        invoice.party = party
+        invoice.invoice_date = period.start_date
+        line = invoice.lines.new()
+        line.account = accounts['revenue']
+        line.description = 'Test'
+        line.quantity = 2
+        line.unit_price = Decimal('100.00')
+        line.taxes.append(tax)
+        invoice.click('post')
+
+        # Close the period stores the amounts of all the tax codes
+        TaxCode = Model.get('account.tax.code')
+
+        def get_balances():
+            # The balances are not exposed to the clients
+            with Transaction().start(config.database_name, config.user,
+                    readonly=True):
+                Balance = Pool().get('aeat.303.tax.code.balance')
+                return {b.code.id: b.amount
+                    for b in Balance.search([('period', '=', period.id)])}
+
+        def get_amounts():
+            with config.set_context(periods=[period.id]):
+                return {c.id: c.amount for c in TaxCode.find([
+                            ('id', 'in', [base_child.id, tax_child.id]),
+                            ])}
+
+        self.assertEqual(get_balances(), {})
+        period.click('close')
+        balances = get_balances()
+        self.assertEqual(len(balances), 4)
+        self.assertEqual(balances[base_code.id], Decimal('0.00'))
+        self.assertEqual(balances[tax_code.id], Decimal('0.00'))
+        self.assertEqual(balances[base_child.id], Decimal('200.00'))
+        self.assertEqual(balances[tax_child.id], Decimal('42.00'))
+        self.assertEqual(get_amounts(), {
+                base_child.id: balances[base_child.id],
+                tax_child.id: balances[tax_child.id],
+                })
+
+        # Calculate the report from the stored amounts
+        Report = Model.get('aeat.303.report')
+        report = Report()
+        report.year = period.start_date.year
+        report.period = '%02d' % period.start_date.month
+        report.type = 'I'
+        report.return_sepa_check = '0'
+        report.exonerated_mod390 = '0' if report.period != '12' else '2'
+        report.company_vat = '123456789'
+        report.click('calculate')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('200.00'))
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('42.00'))
+        self.assertEqual(report.accrued_vat_percent_3, Decimal('21.00'))
+
+        # Reopen the period removes its stored amounts
+        period.click('reopen')
+        self.assertEqual(get_balances(), {})
+        period.click('close')
+        self.assertEqual(len(get_balances()), 4)
+
+        # Modify a code line removes the stored amounts
+        code_line, = base_child.lines
+        code_line.operator = '-'
+        base_child.save()
+        self.assertEqual(get_balances(), {})
+        report.click('draft')
+        report.click('force_calculate')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('-200.00'))
+        self.assertEqual(report.accrued_vat_tax_3, Decimal('42.00'))
+        code_line, = base_child.lines
+        code_line.operator = '+'
+        base_child.save()
+        self.assertEqual(get_balances(), {})
+        report.click('draft')
+        report.click('force_calculate')
+        self.assertEqual(report.accrued_vat_base_3, Decimal('200.00'))
+
+        # Process the report stores the amounts of its closed periods
+        period.reload()
+        self.assertEqual(period.state, 'closed')
+        report.click('process')
+        self.assertEqual(report.state, 'done')
+        balances = get_balances()
+        self.assertEqual(len(balances), 4)
+        self.assertEqual(get_amounts(), {
+                base_child.id: balances[base_child.id],
+                tax_child.id: balances[tax_child.id],
+                })
@@ -0,0 +1,163 @@
+import io
+import sys
+import unittest
+from contextlib import redirect_stdout
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model, Wizard
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.aeat_303 import verify
+from trytond.modules.aeat_303.tests.tools import (
+    create_mapping, create_tax_code_tree)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.currency.tests.tools import get_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install aeat_303
+        config = activate_modules(['aeat_303', 'account_invoice'])
+
+        # Create company
+        eur = get_currency('EUR')
+        _ = create_company(currency=eur)
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+        period = fiscalyear.periods[0]
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create tax with its codes
+        tax = create_tax(Decimal('.21'))
+        tax.save()
+        base_code, _ = create_tax_code_tree(tax, 'base')
+        tax_code, _ = create_tax_code_tree(tax, 'tax')
+
+        # Create the mappings of the codes, the numeric ones are created
+        # with the chart
+        _ = create_mapping(company, 'accrued_vat_base_3', [base_code])
+        _ = create_mapping(company, 'accrued_vat_tax_3', [tax_code])
+
+        # Create party
+        Party = Model.get('party.party')
+        party = Party(name='Party')
+        party.save()
+
+        # Post an out invoice
+        Invoice = Model.get('account.invoice')
+        invoice = Invoice(type='out')
+        invoice.party = party
+        invoice.invoice_date = period.start_date
+        line = invoice.lines.new()
+        line.account = accounts['revenue']
+        line.description = 'Test'
+        line.quantity = 2
+        line.unit_price = Decimal('120.00')
+        line.taxes.append(tax)
+        invoice.click('post')
+
+        # Process the report
+        Report = Model.get('aeat.303.report')
+        report = Report()
+        report.year = period.start_date.year
+        report.period = '%02d' % period.start_date.month
+        report.type = 'I'
+        report.return_sepa_check = '0'
+        report.exonerated_mod390 = '0' if report.period != '12' else '2'
+        report.company_vat = '123456789'
+        report.click('calculate')
+        report.click('process')
+        self.assertEqual(report.state, 'done')
+        data = bytes(report.file_)
+
+        # Import the file of the report twice
+        for _ in range(2):
+            import_ = Wizard('aeat.303.report.import')
+            import_.form.company = company
+            import_.form.file_ = data
+            import_.form.filename = 'aeat303.txt'
+            import_.execute('import_')
+        file_report, column_report = Report.find(
+            [('id', '!=', report.id)], order=[('id', 'ASC')])
+
+        # Tamper the stored file of a report and a column of the other
+        with Transaction().start(config.database_name, config.user,
+                context=config.context):
+            ReportModel = Pool().get('aeat.303.report')
+            ReportModel.write([ReportModel(file_report.id)], {
+                    'file_': data.replace(b'123456789', b'987654321', 1),
+                    })
+            ReportModel.write([ReportModel(column_report.id)], {
+                    'accrued_vat_tax_3': Decimal('60.00'),
+                    })
+
+        # The regenerated files are compared with the stored files
+        with Transaction().start(config.database_name, config.user,
+                context=config.context, readonly=True):
+            ReportModel = Pool().get('aeat.303.report')
+            result = ReportModel.verify_files(ReportModel.browse(
+                    [report.id, file_report.id, column_report.id]))
+        self.assertEqual(result[report.id], [])
+        self.assertEqual(result[file_report.id], [
+                ('file', 'company_vat', '987654321', '123456789'),
+                ])
+        self.assertEqual(
+            sorted(name for _, name, _, _ in result[column_report.id]),
+            sorted(['accrued_vat_tax_3', 'accrued_total_tax',
+                    'general_regime_result', 'sum_results',
+                    'state_administration_amount', 'result',
+                    'liquidation_result']))
+        self.assertEqual({
+                (source, found) for source, name, _, found
+                in result[column_report.id]
+                if name == 'accrued_vat_tax_3'}, {
+                ('file', '00000000000006000'),
+                })
+
+        # The worker processes give the same mismatches, they can not open an
+        # in-memory database
+        if config.database_name != ':memory:':
+            self.assertEqual(
+                verify.verify(config.database_name, processes=1), result)
+
+            output = io.StringIO()
+            with patch.object(sys, 'argv', [
+                        'verify', '-d', config.database_name, '-p', '1']), \
+                    redirect_stdout(output):
+                verify.main()
+            lines = output.getvalue().splitlines()
+            self.assertEqual(lines[:2], [
+                    'Reports: 3', 'Reports with mismatches: 2'])
+            self.assertEqual(sorted(lines[2:]), sorted(
+                    'file\t%s\t1' % name for name in [
+                        'company_vat', 'accrued_vat_tax_3',
+                        'accrued_total_tax', 'general_regime_result',
+                        'sum_results', 'state_administration_amount',
+                        'result', 'liquidation_result']))
+        self.assertEqual(
+            verify._verify(config.database_name,
+                [report.id, file_report.id, column_report.id]), result)
@@ -0,0 +1,56 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from proteus import Model
+from trytond.modules.account.tests.tools import create_tax_code
+
+
+def create_tax_code_tree(tax, amount='tax', type='invoice', config=None):
+    "Create a parent tax code with a child tax code for the tax"
+    TaxCode = Model.get('account.tax.code', config=config)
+
+    parent = TaxCode(name="Parent Tax Code %s %s" % (tax.name, amount))
+    parent.company = tax.company
+    parent.save()
+    child = create_tax_code(tax, amount=amount, type=type, config=config)
+    child.name = "Tax Code %s %s" % (tax.name, amount)
+    child.parent = parent
+    child.save()
+    return parent, child
+
+
+def get_report_field(name, config=None):
+    "Return the field of the 303 report"
+    Field = Model.get('ir.model.field', config=config)
+
+    field, = Field.find([
+            ('model', '=', 'aeat.303.report'),
+            ('name', '=', name),
+            ])
+    return field
+
+
+def create_mapping(company, name, codes=None, number=None, type_=None,
+        config=None):
+    "Create the 303 mapping of the report field to the codes or the number"
+    Mapping = Model.get('aeat.303.mapping', config=config)
+
+    mapping = Mapping()
+    mapping.company = company
+    mapping.aeat303_field = get_report_field(name, config=config)
+    mapping.type_ = type_ or ('numeric' if number is not None else 'code')
+    mapping.number = number
+    mapping.code.extend(codes or [])
+    mapping.save()
+    return mapping
+
+
+def create_prorrata_mapping(company, name, codes, config=None):
+    "Create the 303 prorrata mapping of the report field to the codes"
+    Mapping = Model.get('aeat.303.prorrata.mapping', config=config)
+
+    mapping = Mapping()
+    mapping.company = company
+    mapping.prorrata_field = get_report_field(name, config=config)
+    mapping.code.extend(codes)
+    mapping.save()
+    return mapping
@@ -0,0 +1,101 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Verify the AEAT 303 files of the reports of a database.
+
+The file of each report is regenerated and compared field by field with the
+stored file and with the report columns. The reports are verified by chunks
+in parallel worker processes:
+
+    python -m trytond.modules.aeat_303.verify -c trytond.conf -d database
+'''
+import argparse
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from trytond.config import config
+from trytond.tools import grouped_slice
+
+
+def _init(database, config_file):
+    from trytond.pool import Pool
+
+    if config_file:
+        config.update_etc(config_file)
+    Pool.start()
+    Pool(database).init()
+
+
+def _verify(database, ids):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    with Transaction().start(database, 0, readonly=True):
+        Report = Pool().get('aeat.303.report')
+        return Report.verify_files(Report.browse(ids))
+
+
+def verify(database, ids=None, processes=None, chunk_size=100,
+        config_file=None):
+    '''
+    Return the mismatches of the files of the reports by report id
+
+    All the reports are verified if no ids are given.
+    '''
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    _init(database, config_file)
+    if ids is None:
+        with Transaction().start(database, 0, readonly=True):
+            Report = Pool().get('aeat.303.report')
+            ids = [r.id for r in Report.search([], order=[('id', 'ASC')])]
+
+    result = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+            initializer=_init, initargs=(database, config_file)) as executor:
+        futures = [executor.submit(_verify, database, list(sub_ids))
+            for sub_ids in grouped_slice(ids, chunk_size)]
+        for future in as_completed(futures):
+            result.update(future.result())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config_file',
+        default=os.environ.get('TRYTOND_CONFIG'))
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+        default=os.cpu_count())
+    parser.add_argument('-s', '--chunk-size', dest='chunk_size', type=int,
+        default=100)
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='print the mismatches of each report')
+    parser.add_argument('ids', nargs='*', type=int,
+        help='the ids of the reports, all by default')
+    options = parser.parse_args()
+
+    result = verify(options.database, ids=options.ids or None,
+        processes=options.processes, chunk_size=options.chunk_size,
+        config_file=options.config_file)
+
+    summary = Counter()
+    for report_id, mismatches in sorted(result.items()):
+        for source, name, expected, found in mismatches:
+            summary[(source, name)] += 1
+            if options.verbose:
+                print('%s\t%s\t%s\t%r\t%r' % (
+                        report_id, source, name, expected, found))
+    print('Reports: %s' % len(result))
+    print('Reports with mismatches: %s'
+        % len([m for m in result.values() if m]))
+    for (source, name), count in summary.most_common():
+        print('%s\t%s\t%s' % (source, name, count))
+
+
+if __name__ == '__main__':
+    main()